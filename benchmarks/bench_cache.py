@@ -0,0 +1,30 @@
+"""
+BaseWidgetHandler.get_cache on its hit and miss paths, against the
+in-process cache.
+
+    python benchmarks/bench_cache.py
+"""
+import common
+
+from django.core.cache import cache
+
+from marimo.local_cache import local_cache
+
+from benchmarks.handlers import CommentsWidget
+
+
+def cases():
+    handler = CommentsWidget()
+    handler.get_cache(1)
+
+    def evict():
+        cache.delete(handler.cache_key(1))
+        local_cache.clear()
+
+    yield common.Case('handler.get_cache', lambda: handler.get_cache(1), {'path': 'hit'}, number=200)
+    yield common.Case('handler.get_cache', lambda: handler.get_cache(1), {'path': 'miss'},
+                      number=200, setup=evict)
+
+
+if __name__ == '__main__':
+    common.report(cases())
@@ -0,0 +1,71 @@
+"""
+The middleware filling in the widget script on pages of 10KB to 10MB,
+built as one string and streamed in 64KB chunks.
+
+    python benchmarks/bench_middleware.py
+"""
+import common
+
+from django.http import HttpResponse
+
+from marimo.middleware import Marimo, MarimoEventContainer, MARIMO_PLACEHOLDER
+
+
+class PageRequest(object):
+    """ just what the middleware looks at """
+
+    def __init__(self, widgets):
+        self.marimo_widgets = widgets
+        self.marimo_writecapture_delay = MarimoEventContainer()
+
+
+def page(size):
+    """ size bytes of html with the placeholder near the end """
+    filler = '<p>' + 'x' * 96 + '</p>\n'
+    body = filler * (size // len(filler))
+    return body + '<script>' + MARIMO_PLACEHOLDER + '</script>'
+
+
+def widgets(count):
+    return [{
+        'id': 'comments_%d' % i,
+        'widget_name': 'comments',
+        'widget_prototype': 'request_widget',
+        'murl': '/marimo/',
+        'args': [i],
+        'kwargs': {'page': 1},
+    } for i in range(count)]
+
+
+def process_case(size, mode):
+    middleware = Marimo()
+    request = PageRequest(widgets(20))
+    content = page(size)
+    chunk = 64 * 1024
+    state = {}
+
+    def setup():
+        if mode == 'stream':
+            chunks = [content[i:i + chunk] for i in xrange(0, len(content), chunk)]
+            state['response'] = HttpResponse(iter(chunks))
+        else:
+            state['response'] = HttpResponse(content)
+
+    def process():
+        response = middleware.process_response(request, state['response'])
+        if mode == 'stream':
+            for part in response:
+                pass
+
+    return common.Case('middleware.process_response', process, {'bytes': size, 'mode': mode},
+                       number=max(1, (1024 * 1024) // size), setup=setup)
+
+
+def cases():
+    for size in (10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024):
+        for mode in ('string', 'stream'):
+            yield process_case(size, mode)
+
+
+if __name__ == '__main__':
+    common.report(cases())
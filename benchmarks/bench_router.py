@@ -0,0 +1,72 @@
+"""
+Routing bulk requests of 1 to 500 widgets through MarimoRouter at
+different shares of cache hits, against the in-process cache.
+
+    python benchmarks/bench_router.py
+"""
+import copy
+import json
+
+import common
+
+from django.core.cache import cache
+from django.test.client import RequestFactory
+
+from marimo.local_cache import local_cache
+from marimo.views import MarimoRouter
+
+from benchmarks.handlers import CommentsWidget
+
+
+def bulk_request(widgets):
+    return [{
+        'id': 'comments_%d' % i,
+        'widget_name': 'comments',
+        'args': [i],
+        'kwargs': {'page': 1},
+    } for i in range(widgets)]
+
+
+def route_case(widgets, hit_ratio):
+    request = RequestFactory().get('/marimo/')
+    bulk = bulk_request(widgets)
+    hits = bulk[:int(widgets * hit_ratio)]
+    state = {}
+
+    keys = [CommentsWidget().cache_key(*widget['args']) for widget in bulk]
+
+    def prime():
+        cache.clear()
+        local_cache.clear()
+        if hits:
+            MarimoRouter().warm(request, hits)
+        cached = len(cache.get_many(keys))
+        assert cached == len(hits), '%d of %d widgets cached, expected %d' % (
+            cached, widgets, len(hits))
+        state['bulk'] = copy.deepcopy(bulk)
+
+    def setup():
+        prime()
+        if 'checked' not in state:
+            # make sure the router really runs the widgets
+            response = MarimoRouter().route(request, state['bulk'])
+            statuses = set(data['status'] for data in json.loads(response.content))
+            assert statuses == set(['succeeded']), 'widgets answered %s' % ', '.join(statuses)
+            state['checked'] = True
+            prime()
+
+    def route():
+        MarimoRouter().route(request, state['bulk'])
+
+    return common.Case('router.route', route, {'widgets': widgets, 'hit_ratio': hit_ratio},
+                       number=max(1, 200 // widgets), setup=setup)
+
+
+def cases():
+    for widgets in (1, 10, 100, 500):
+        for hit_ratio in (0.0, 0.5, 1.0):
+            yield route_case(widgets, hit_ratio)
+
+
+if __name__ == '__main__':
+    common.report(cases())
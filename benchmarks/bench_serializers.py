@@ -0,0 +1,77 @@
+"""
+Compares the installed MARIMO_SERIALIZER backends, and MessagePack, on the
+payloads marimo encodes and decodes on every page: the bulk request the
+router parses and the widget data it sends back, along with their sizes
+(recorded as ``bytes`` in the results). Backends that aren't installed are
+left out.
+
+    python benchmarks/bench_serializers.py
+"""
+import common
+
+from django.core.exceptions import ImproperlyConfigured
+
+from marimo.serializers import BACKENDS, get_serializer, msgpack_serializer
+
+
+def bulk_request(widgets):
+    """ what the client sends for a page of widgets """
+    return [{
+        'id': 'comments_%08x' % i,
+        'widget_name': 'comments',
+        'widget_prototype': 'request_widget',
+        'murl': '/marimo/',
+        'args': [1000 + i, 'list'],
+        'kwargs': {'page': i % 5, 'section': u'news', 'sort': 'newest'},
+    } for i in range(widgets)]
+
+
+def bulk_response(widgets):
+    """ what the router sends back for it """
+    return [{
+        'id': 'comments_%08x' % i,
+        'status': 'succeeded',
+        'template': '<ul>{{#comments}}<li><b>{{author}}</b> {{body}}</li>{{/comments}}</ul>',
+        'context': {
+            'count': 10,
+            'rating': 4.25,
+            'comments': [{
+                'author': u'reader %d' % c,
+                'body': u'This is comment %d, with some unicode \u2603 in it.' % c,
+                'votes': c * 3,
+                'flagged': False,
+            } for c in range(10)],
+        },
+    } for i in range(widgets)]
+
+
+def formats():
+    """ every installed serializer, including MessagePack """
+    found = []
+    for name in sorted(BACKENDS):
+        try:
+            found.append(get_serializer(name))
+        except ImproperlyConfigured:
+            pass
+    if msgpack_serializer is not None:
+        found.append(msgpack_serializer)
+    return found
+
+
+def cases(widgets=50):
+    request = bulk_request(widgets)
+    response = bulk_response(widgets)
+    for serializer in formats():
+        request_data = serializer.dumps(request)
+        response_data = serializer.dumps(response)
+        params = {'format': serializer.name, 'widgets': widgets}
+        yield common.Case('serializers.loads_request', lambda s=serializer, d=request_data: s.loads(d),
+                          params, number=100, extra={'bytes': len(request_data)})
+        yield common.Case('serializers.dumps_response', lambda s=serializer: s.dumps(response),
+                          params, number=100, extra={'bytes': len(response_data)})
+        yield common.Case('serializers.loads_response', lambda s=serializer, d=response_data: s.loads(d),
+                          params, number=100, extra={'bytes': len(response_data)})
+
+
+if __name__ == '__main__':
+    common.report(cases())
@@ -0,0 +1,84 @@
+"""
+The cost of rendering pages full of {% marimo %} and {% writecapture %}
+tags.
+
+The marimo tag is also rendered the way it was before its arguments were
+compiled at parse time (a Variable per argument, built on every render), to
+show the difference.
+
+    python benchmarks/bench_tags.py
+"""
+import common
+
+from django import template
+from django.conf import settings
+
+from marimo.templatetags.marimo import MarimoNode
+
+
+class LegacyMarimoNode(MarimoNode):
+    """ the render path of the tag before parse time compilation """
+
+    def render(self, context):
+        def maybe_resolve(arg):
+            if arg[0] == '"' and arg[-1] == '"':
+                return arg.strip('"')
+            return template.Variable(arg).resolve(context)
+
+        data = {}
+        data['kwargs'] = {}
+        for (k, v) in self.kwargs.items():
+            data['kwargs'][k] = maybe_resolve(v)
+        data['args'] = [maybe_resolve(arg) for arg in self.args]
+        data['widget_name'] = self.widget_name
+        data['murl'] = settings.MARIMO_URL
+        data['id'] = self.generate_id(context, data)
+        data['widget_prototype'] = self.prototype
+        context['marimo_widgets'].append(data)
+        return '<div id="%s" class="marimo class"></div>' % data['id']
+
+
+MARIMO_TAG = '{% marimo comments request_widget article.pk "list" page=page.number section="news" %}'
+WRITECAPTURE_TAG = ('{% writecapture %}<script src="/ads.js"></script>'
+                    '<script>document.write("ad {{ page.number }}");</script>{% endwritecapture %}')
+
+
+def page_context():
+    return template.Context({
+        'article': {'pk': 23},
+        'page': {'number': 2},
+        'marimo_widgets': [],
+        'marimo_ids': {},
+    })
+
+
+def legacy_template(source):
+    legacy = template.Template(source)
+    for node in legacy.nodelist:
+        if isinstance(node, MarimoNode):
+            node.__class__ = LegacyMarimoNode
+            node.args = ['article.pk', '"list"']
+            node.kwargs = {'page': 'page.number', 'section': '"news"'}
+    return legacy
+
+
+def render(tpl):
+    return lambda: tpl.render(page_context())
+
+
+def cases():
+    source = '{% load marimo %}' + MARIMO_TAG * 200
+    yield common.Case('tags.marimo', render(legacy_template(source)),
+                      {'tags': 200, 'version': 'before'})
+    yield common.Case('tags.marimo', render(template.Template(source)),
+                      {'tags': 200, 'version': 'after'})
+    for tags in (1000, 5000):
+        yield common.Case('tags.marimo', render(template.Template('{% load marimo %}' + MARIMO_TAG * tags)),
+                          {'tags': tags}, number=2)
+        yield common.Case('tags.writecapture',
+                          render(template.Template('{% load writecapture %}' + WRITECAPTURE_TAG * tags)),
+                          {'tags': tags}, number=2)
+
+
+if __name__ == '__main__':
+    common.report(cases())
@@ -0,0 +1,71 @@
+"""
+What the benchmark scripts share: the import setup, the Case they describe
+their measurements with, and timing.
+
+Importing this puts the repository on sys.path and selects
+benchmarks.settings unless DJANGO_SETTINGS_MODULE is set.
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+
+class Case(object):
+    """
+    One measurement.
+
+    :param name: what is measured, e.g. 'router.route'
+    :param fn: the code that is timed
+    :param params: the inputs that vary between cases of the same name
+    :param number: how often fn runs per repetition
+    :param setup: runs untimed before every call of fn
+    :param extra: other numbers worth recording, e.g. a payload size
+    """
+
+    def __init__(self, name, fn, params=None, number=10, setup=None, extra=None):
+        self.name = name
+        self.fn = fn
+        self.params = params or {}
+        self.number = number
+        self.setup = setup
+        self.extra = extra or {}
+
+    def label(self):
+        params = ' '.join('%s=%s' % item for item in sorted(self.params.items()))
+        return '%s %s' % (self.name, params)
+
+
+def measure(case, repeat=5):
+    """ times case and returns its result as a dict of plain values """
+    timings = []
+    for i in xrange(repeat):
+        elapsed = 0.0
+        for j in xrange(case.number):
+            if case.setup:
+                case.setup()
+            start = time.time()
+            case.fn()
+            elapsed += time.time() - start
+        timings.append(elapsed / case.number)
+    result = {
+        'name': case.name,
+        'params': case.params,
+        'repeat': repeat,
+        'number': case.number,
+        'best': min(timings),
+        'mean': sum(timings) / len(timings),
+    }
+    result.update(case.extra)
+    return result
+
+
+def report(cases, repeat=5):
+    """ measures cases and prints a line for each, for running a script alone """
+    for case in cases:
+        result = measure(case, repeat)
+        print '%-60s %12.1f us' % (case.label(), result['best'] * 1e6)
@@ -0,0 +1,22 @@
+""" the widget handlers the benchmarks route """
+from marimo.views import BaseWidget
+
+
+class CommentsWidget(BaseWidget):
+    """ a typical request widget: cached comments plus a per user bit """
+    template = '<ul>{{#comments}}<li><b>{{author}}</b> {{body}}</li>{{/comments}}</ul>'
+
+    def cache_key(self, *args, **kwargs):
+        return 'bench:comments:%s' % args[0]
+
+    def cacheable(self, response, *args, **kwargs):
+        response['context']['comments'] = [{
+            'author': u'reader %d' % c,
+            'body': u'This is comment %d on article %s.' % (c, args[0]),
+            'votes': c * 3,
+        } for c in range(10)]
+        return response
+
+    def uncacheable(self, request, response, *args, **kwargs):
+        response['context']['can_comment'] = True
+        return response
@@ -0,0 +1,61 @@
+"""
+Runs every benchmark and writes the results as JSON, so runs can be saved
+and compared.
+
+    python benchmarks/run.py [-o results.json] [-k name] [-r repeat]
+
+Each result records the case's name and params and the best and mean
+seconds per call over ``repeat`` repetitions of ``number`` calls. Some
+cases add their own numbers, e.g. payload ``bytes``.
+"""
+import json
+import optparse
+import platform
+import sys
+import time
+
+import common
+
+import django
+
+MODULES = ['bench_router', 'bench_cache', 'bench_middleware', 'bench_tags', 'bench_serializers']
+
+
+def run(keyword=None, repeat=5):
+    results = []
+    for module_name in MODULES:
+        module = __import__(module_name)
+        for case in module.cases():
+            if keyword and keyword not in case.label():
+                continue
+            result = common.measure(case, repeat)
+            sys.stderr.write('%-60s %12.1f us\n' % (case.label(), result['best'] * 1e6))
+            results.append(result)
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', help='write the JSON here instead of to stdout')
+    parser.add_option('-k', '--keyword', help='only run cases whose name or params contain this')
+    parser.add_option('-r', '--repeat', type='int', default=5)
+    options, args = parser.parse_args()
+    data = json.dumps(run(options.keyword, options.repeat), indent=2, sort_keys=True)
+    if options.output:
+        output = open(options.output, 'w')
+        try:
+            output.write(data + '\n')
+        finally:
+            output.close()
+    else:
+        print data
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+"""
+Settings the benchmarks run with: the test settings, but with a real
+(in-process) cache so cache hits and misses cost what they do in production
+minus the network.
+"""
+from marimo.test_settings import *
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    }
+}
+MARIMO_URL = '/marimo/'
+MARIMO_FAST = True
+MARIMO_REGISTRY = 'benchmarks.widgets.registry'
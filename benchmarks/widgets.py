@@ -0,0 +1,7 @@
+"""
+The benchmark widget registry. Handlers are listed by dotted path, so
+importing this doesn't import marimo.views, which loads the registry.
+"""
+registry = {
+    'comments': 'benchmarks.handlers.CommentsWidget',
+}
@@ -0,0 +1,117 @@
+"""
+A small bounded thread pool for running marimo work off the request thread.
+
+The stdlib has no executor on the pythons we support, so this is the bare
+minimum: a fixed number of daemon threads pulling :class:`Task` objects off a
+queue.
+"""
+import Queue
+import sys
+import threading
+import time
+
+from django.db import close_connection
+
+
+class Task(object):
+    """ A unit of work submitted to a :class:`WorkerPool` """
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.started = None
+        self.result = None
+        self.exc_info = None
+        self._finished = threading.Event()
+
+    def run(self):
+        self.started = time.time()
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self._finished.set()
+
+    @property
+    def done(self):
+        return self._finished.isSet()
+
+    def wait(self, timeout=None):
+        """ waits up to timeout seconds and returns True if the task finished """
+        self._finished.wait(timeout)
+        return self._finished.isSet()
+
+
+class WorkerPool(object):
+    """
+    Runs tasks on at most ``size`` threads. Threads are started lazily on the
+    first submit so importing this module is free.
+
+    :param size: the number of worker threads
+    :param max_queue: how many tasks may wait for a thread; 0 is unbounded
+    """
+
+    def __init__(self, size, max_queue=0):
+        self.size = size
+        self._queue = Queue.Queue(max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._work,
+                                          name='marimo-worker-%d' % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                task.run()
+            finally:
+                # each worker thread holds its own db connection; don't leak it
+                close_connection()
+
+    def submit(self, fn, *args, **kwargs):
+        """ queues fn(*args, **kwargs), blocking if the queue is full """
+        if len(self._threads) < self.size:
+            self._start()
+        task = Task(fn, args, kwargs)
+        self._queue.put(task)
+        return task
+
+    def try_submit(self, fn, *args, **kwargs):
+        """ like submit but returns None instead of blocking if the queue is full """
+        if len(self._threads) < self.size:
+            self._start()
+        task = Task(fn, args, kwargs)
+        try:
+            self._queue.put_nowait(task)
+        except Queue.Full:
+            return None
+        return task
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name, size, max_queue=0):
+    """ returns the process wide pool called name, creating it on first use """
+    try:
+        return _pools[name]
+    except KeyError:
+        _pools_lock.acquire()
+        try:
+            if name not in _pools:
+                _pools[name] = WorkerPool(size, max_queue)
+            return _pools[name]
+        finally:
+            _pools_lock.release()
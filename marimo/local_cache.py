@@ -0,0 +1,106 @@
+"""
+A small in-process cache that sits in front of the django cache for very hot
+widgets so they don't need a network round trip.
+
+Values are stored pickled. That keeps every reader's copy independent (the
+router and uncacheable() modify responses in place) and gives a cheap measure
+of how much memory an entry uses.
+"""
+import cPickle as pickle
+import threading
+import time
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from django.conf import settings
+
+
+class LocalCache(object):
+    """
+    A thread-safe LRU cache bounded by entry count and by the approximate
+    size in bytes of its pickled values. Every entry has its own timeout.
+
+    :param max_entries: the most entries kept at once
+    :param max_bytes: the most pickled bytes kept at once
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=10*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            try:
+                expires, size, pickled = self._entries.pop(key)
+            except KeyError:
+                return default
+            if expires <= time.time():
+                self.size -= size
+                return default
+            # re-inserting moves the key to the most recently used end
+            self._entries[key] = (expires, size, pickled)
+        finally:
+            self._lock.release()
+        return pickle.loads(pickled)
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, timeout):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        size = len(pickled)
+        self._lock.acquire()
+        try:
+            self._delete(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (time.time() + timeout, size, pickled)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._delete(iter(self._entries).next())
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._delete(key)
+        finally:
+            self._lock.release()
+
+    def _delete(self, key):
+        try:
+            expires, size, pickled = self._entries.pop(key)
+        except KeyError:
+            return
+        self.size -= size
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries = OrderedDict()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+local_cache = LocalCache(
+    getattr(settings, 'MARIMO_LOCAL_CACHE_ENTRIES', 1000),
+    getattr(settings, 'MARIMO_LOCAL_CACHE_BYTES', 10*1024*1024),
+)
@@ -0,0 +1,72 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from marimo.slow_log import read_records
+
+
+def percentile(values, share):
+    """ the value share (0 to 1) of the way up the sorted values """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+class Command(BaseCommand):
+    help = ("Summarizes the marimo slow request log (MARIMO_SLOW_LOG): the "
+            "widgets that took the most time, with their cache miss rates "
+            "and response sizes.")
+    option_list = BaseCommand.option_list + (
+        make_option('--file', dest='path',
+                    help='the log to read instead of MARIMO_SLOW_LOG'),
+        make_option('--top', dest='top', type='int', default=10,
+                    help='how many widgets to list (default 10)'),
+    )
+
+    def handle(self, *args, **options):
+        path = options.get('path') or getattr(settings, 'MARIMO_SLOW_LOG', None)
+        if not path:
+            raise CommandError('set MARIMO_SLOW_LOG or pass --file')
+
+        requests = []
+        widgets = {}
+        for record in read_records(path):
+            requests.append(record['elapsed'])
+            for widget in record.get('widgets', []):
+                stats = widgets.setdefault(widget['widget_name'], {
+                    'totals': [], 'cacheable': 0.0, 'uncacheable': 0.0,
+                    'misses': 0, 'cached': 0, 'failures': 0, 'bytes': [],
+                })
+                timings = widget.get('timings') or {}
+                stats['totals'].append(timings.get('total') or 0.0)
+                stats['cacheable'] += timings.get('cacheable') or 0.0
+                stats['uncacheable'] += timings.get('uncacheable') or 0.0
+                if widget.get('cache'):
+                    stats['cached'] += 1
+                    if widget['cache'] == 'miss':
+                        stats['misses'] += 1
+                if widget.get('status') != 'succeeded':
+                    stats['failures'] += 1
+                if widget.get('bytes') is not None:
+                    stats['bytes'].append(widget['bytes'])
+
+        if not requests:
+            self.stdout.write('no requests recorded in %s\n' % path)
+            return
+        self.stdout.write('%d requests, p50 %.1fms, p95 %.1fms, max %.1fms\n\n' % (
+            len(requests), percentile(requests, 0.5) * 1000,
+            percentile(requests, 0.95) * 1000, max(requests) * 1000))
+
+        ranked = sorted(widgets.items(), key=lambda item: -sum(item[1]['totals']))
+        self.stdout.write('%-30s %6s %10s %10s %10s %10s %10s %6s %6s %8s\n' % (
+            'widget', 'calls', 'total ms', 'mean ms', 'p95 ms', 'cacheable', 'uncache.',
+            'miss%', 'fail', 'bytes'))
+        for name, stats in ranked[:options['top']]:
+            calls = len(stats['totals'])
+            total = sum(stats['totals'])
+            miss_rate = stats['cached'] and 100.0 * stats['misses'] / stats['cached'] or 0.0
+            size = stats['bytes'] and sum(stats['bytes']) / len(stats['bytes']) or 0
+            self.stdout.write('%-30s %6d %10.1f %10.1f %10.1f %10.1f %10.1f %6.1f %6d %8d\n' % (
+                name[:30], calls, total * 1000, total / calls * 1000,
+                percentile(stats['totals'], 0.95) * 1000, stats['cacheable'] * 1000,
+                stats['uncacheable'] * 1000, miss_rate, stats['failures'], size))
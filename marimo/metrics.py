@@ -0,0 +1,85 @@
+"""
+Per widget timings and cache events.
+
+marimo reports to the hook named by MARIMO_METRICS, the dotted path of a
+class with the methods of :class:`LoggingMetrics`. The default logs to the
+``marimo.metrics`` logger at DEBUG level; subclass it or write your own to
+send the numbers to statsd or the like.
+"""
+from __future__ import absolute_import
+
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from marimo.utils import smart_import
+
+
+class LoggingMetrics(object):
+    """ logs every measurement to the marimo.metrics logger """
+
+    def __init__(self):
+        self.logger = logging.getLogger('marimo.metrics')
+
+    def cache_event(self, handler, event, cache_key, duration=None):
+        """
+        Something happened to a handler's cache entry. event is one of
+
+        * ``'hit'``: the entry was found
+        * ``'stale'``: the entry was found but is due for a refresh
+        * ``'miss'``: the entry wasn't found
+        * ``'regenerate'``: cacheable() ran for a missing entry, taking
+          duration seconds
+        * ``'refresh'``: cacheable() ran in the background for a stale
+          entry, taking duration seconds
+
+        handler is the name of the handler's class.
+        """
+        if duration is None:
+            self.logger.debug('%s cache %s %s', handler, event, cache_key)
+        else:
+            self.logger.debug('%s cache %s %s %.1fms', handler, event, cache_key,
+                              duration * 1000)
+
+    def widget_timing(self, widget_name, widget_id, cache, timings):
+        """
+        A widget finished. cache is 'hit', 'stale', 'miss' or None for
+        widgets without a cache key or when it isn't known (handlers called
+        directly only report it through cache_event). timings holds the
+        seconds spent in the ``cacheable`` and ``uncacheable`` phases and in
+        ``total``; a phase that didn't run (or didn't finish in time) is
+        None.
+        """
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        phases = ' '.join('%s=%s' % (phase, format_ms(timings.get(phase)))
+                          for phase in ('cacheable', 'uncacheable', 'total'))
+        self.logger.debug('%s %s cache=%s %s', widget_name, widget_id, cache, phases)
+
+
+def format_ms(seconds):
+    if seconds is None:
+        return '-'
+    return '%.1fms' % (seconds * 1000)
+
+
+def get_metrics(path=None):
+    """ returns an instance of the hook class at path, LoggingMetrics by default """
+    if path is None:
+        return LoggingMetrics()
+    try:
+        return smart_import(path)()
+    except (ImportError, AttributeError, ValueError), e:
+        raise ImproperlyConfigured('unknown marimo metrics hook %r: %s' % (path, e))
+
+
+hook = get_metrics(getattr(settings, 'MARIMO_METRICS', None))
+
+
+def cache_event(handler, event, cache_key, duration=None):
+    hook.cache_event(handler, event, cache_key, duration)
+
+
+def widget_timing(widget_name, widget_id, cache, timings):
+    hook.widget_timing(widget_name, widget_id, cache, timings)
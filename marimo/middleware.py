@@ -1,10 +1,29 @@
-import json
-import re
-
+from django.conf import settings
 from django.core.cache import cache
+from django.utils.encoding import smart_str
+
+from marimo import serializers
+from marimo.executor import get_pool
+from marimo.views.router import MarimoRouter
 
-# TODO: this seems like it should be a django setting
-MARIMO_PLACEHOLDER = re.compile("\$\{MARIMO\}")
+MARIMO_PLACEHOLDER = smart_str(getattr(settings, 'MARIMO_PLACEHOLDER', '${MARIMO}'))
+# only responses of these content types are searched for the placeholder
+MARIMO_CONTENT_TYPES = getattr(settings, 'MARIMO_CONTENT_TYPES',
+                               ('text/html', 'application/xhtml+xml'))
+# run the page's widgets while generating it and embed their responses:
+# None (off), 'selected' (handlers that set inline) or 'all'
+MARIMO_INLINE = getattr(settings, 'MARIMO_INLINE', None)
+# seconds a page may spend running widgets for MARIMO_INLINE
+MARIMO_INLINE_BUDGET = getattr(settings, 'MARIMO_INLINE_BUDGET', 0.1)
+# fill the cache for the page's widgets on a background thread while the
+# page is sent, so the cache is warm when the bulk request comes in
+MARIMO_PREFETCH = getattr(settings, 'MARIMO_PREFETCH', False)
+# threads used for MARIMO_PREFETCH, and how many pages may wait for one;
+# pages that find the queue full are not prefetched
+MARIMO_PREFETCH_THREADS = getattr(settings, 'MARIMO_PREFETCH_THREADS', 2)
+MARIMO_PREFETCH_QUEUE = getattr(settings, 'MARIMO_PREFETCH_QUEUE', 50)
+# what the placeholder becomes on pages that registered nothing
+EMPTY_CODE = "marimo.add_widgets([]);"
 
 
 class MarimoEventContainer(object):
@@ -35,24 +54,137 @@ class Marimo(object):
         """ sticks marimo_widgets in the request """
         request.marimo_widgets = []
         request.marimo_writecapture_delay = MarimoEventContainer()
+        # how often each widget id was handed out, see utils.widget_id
+        request.marimo_ids = {}
 
     def process_response(self, request, response):
         """ generates a script to register and load the widgets with marimo """
-        # TODO: check to maker sure the placeholder exists
         # TODO: add_widgets shouldn't make the request
         if not hasattr(request, 'marimo_widgets'):
             # skip this
             return response
-        code = "marimo.add_widgets(%s);" %json.dumps(request.marimo_widgets)
+        if not self.should_process(response):
+            return response
+        if getattr(response, 'streaming', False):
+            response.streaming_content = self.rewrite_stream(request, response.streaming_content)
+            return self.drop_content_length(response)
+        if not getattr(response, '_is_string', True):
+            # django < 1.5 streams any HttpResponse made from an iterator
+            response._container = self.rewrite_stream(request, response._container)
+            return self.drop_content_length(response)
+        content = response.content
+        if MARIMO_PLACEHOLDER not in content:
+            return response
 
-        wc_delay = getattr(request, 'marimo_writecapture_delay')
-        if wc_delay.marimo_event:
-            code = "marimo.widgetlib.writecapture_widget.default_render_events" \
-                   " = %s;\n%s" % (json.dumps([wc_delay.marimo_event]), code)
-        response.content = MARIMO_PLACEHOLDER.sub(code, response.content)
+        response.content = content.replace(MARIMO_PLACEHOLDER, self.widget_code(request))
+        nocache_override = getattr(request, 'marimo_nocache_override', None)
+        if nocache_override:
+            response['Cache-Control'] = nocache_override
+        if response.has_header('Content-Length'):
+            response['Content-Length'] = str(len(response.content))
+        return response
+
+    def rewrite_stream(self, request, chunks):
+        """
+        Replaces the placeholder in a streamed response chunk by chunk, only
+        holding back the end of a chunk that could be the start of a
+        placeholder split across chunks.
+
+        The script is built when the placeholder goes by, so on pages that
+        are rendered while they stream it only has the widgets registered
+        above it. The headers are gone by then, so widgets that need a
+        no-cache header are left to the client rather than inlined.
+        """
+        placeholder = MARIMO_PLACEHOLDER
+        held = ''
+        try:
+            for chunk in chunks:
+                data = held + smart_str(chunk)
+                if placeholder in data:
+                    data = data.replace(placeholder, self.widget_code(request, streaming=True))
+                keep = self.partial_placeholder(data)
+                held = data[len(data) - keep:] if keep else ''
+                if len(data) > keep:
+                    yield data[:len(data) - keep]
+            if held:
+                yield held
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
 
+    def partial_placeholder(self, data):
+        """ length of the longest end of data that starts the placeholder """
+        for size in xrange(min(len(MARIMO_PLACEHOLDER) - 1, len(data)), 0, -1):
+            if MARIMO_PLACEHOLDER.startswith(data[-size:]):
+                return size
+        return 0
+
+    def drop_content_length(self, response):
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
         return response
 
+    def should_process(self, response):
+        """ only (x)html responses can contain the placeholder """
+        content_type = response.get('Content-Type', '').split(';')[0].strip().lower()
+        return content_type in MARIMO_CONTENT_TYPES
+
+    def widget_code(self, request, streaming=False):
+        """
+        the script that replaces the placeholder; streaming means the
+        response's headers have already been sent
+        """
+        wc_delay = getattr(request, 'marimo_writecapture_delay', None)
+        event = wc_delay and wc_delay.marimo_event
+        if not request.marimo_widgets and not event:
+            return EMPTY_CODE
+        widgets = self.inline_widgets(request, streaming)
+        if MARIMO_PREFETCH:
+            self.prefetch(request, [w for w in widgets if 'response' not in w])
+        # widget responses hold whatever users entered; never let it end
+        # the script
+        code = "marimo.add_widgets(%s);" % serializers.script_dumps(widgets)
+        if event:
+            code = "marimo.widgetlib.writecapture_widget.default_render_events" \
+                   " = %s;\n%s" % (serializers.script_dumps([event]), code)
+        return code
+
+    def inline_widgets(self, request, streaming=False):
+        """
+        With MARIMO_INLINE, runs the page's widgets through the router and
+        returns request.marimo_widgets with the response of every widget
+        that succeeded within MARIMO_INLINE_BUDGET under its 'response' key.
+        The client doesn't need to request those; the rest are fetched as
+        usual. When streaming, widgets that would need a no-cache header
+        aren't inlined.
+        """
+        if not MARIMO_INLINE or not request.marimo_widgets:
+            return request.marimo_widgets
+        results, nocache_override = MarimoRouter().prefetch(
+            request, request.marimo_widgets, MARIMO_INLINE_BUDGET,
+            selected_only=MARIMO_INLINE != 'all', skip_nocache=streaming)
+        if nocache_override:
+            request.marimo_nocache_override = nocache_override
+        widgets = []
+        for widget in request.marimo_widgets:
+            if widget['id'] in results:
+                widget = dict(widget)
+                widget['response'] = results[widget['id']]
+            widgets.append(widget)
+        return widgets
+
+    def prefetch(self, request, widgets):
+        """
+        Queues the cacheable half of widgets to be cached in the background.
+        This never blocks; if the prefetch queue is full the page is simply
+        not prefetched.
+        """
+        if not widgets:
+            return None
+        pool = get_pool('prefetch', MARIMO_PREFETCH_THREADS, MARIMO_PREFETCH_QUEUE)
+        return pool.try_submit(MarimoRouter().warm, request, widgets)
+
+
 def context_processor(request):
     """ sticks marimo_widgets into the template context """
     extra_context = {}
@@ -60,4 +192,6 @@ def context_processor(request):
         extra_context['marimo_widgets'] = request.marimo_widgets
     if hasattr(request, 'marimo_writecapture_delay'):
         extra_context['marimo_writecapture_delay'] = request.marimo_writecapture_delay
+    if hasattr(request, 'marimo_ids'):
+        extra_context['marimo_ids'] = request.marimo_ids
     return extra_context
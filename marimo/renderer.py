@@ -0,0 +1,68 @@
+"""
+Server side rendering of marimo's mustache templates.
+
+This needs pystache, which is only imported if it is installed; nothing else
+in marimo depends on it.
+"""
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from marimo.template_loader import template_hash
+
+try:
+    import pystache
+except ImportError:
+    pystache = None
+
+MARIMO_COMPILED_TEMPLATES = getattr(settings, 'MARIMO_COMPILED_TEMPLATES', 500)
+
+
+class CompiledTemplateCache(object):
+    """
+    Parsed templates keyed by template content hash, so every template is
+    only parsed once per process.
+
+    :param max_entries: when this many templates are cached the cache is
+        emptied and starts over
+    """
+
+    def __init__(self, max_entries=500):
+        self.max_entries = max_entries
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    def get(self, template):
+        """ returns the parsed version of template, parsing it if needed """
+        thash = template_hash(template)
+        try:
+            return self._compiled[thash]
+        except KeyError:
+            pass
+        compiled = pystache.parse(template)
+        self._lock.acquire()
+        try:
+            if len(self._compiled) >= self.max_entries:
+                self._compiled = {}
+            self._compiled[thash] = compiled
+        finally:
+            self._lock.release()
+        return compiled
+
+    def __len__(self):
+        return len(self._compiled)
+
+
+compiled_templates = CompiledTemplateCache(MARIMO_COMPILED_TEMPLATES)
+if pystache is not None:
+    _renderer = pystache.Renderer()
+
+
+def render_template(template, context):
+    """ renders a mustache template with context and returns the html """
+    if pystache is None:
+        raise ImproperlyConfigured('rendering marimo widgets on the server requires pystache')
+    if isinstance(template, str):
+        template = template.decode('utf-8')
+    return _renderer.render(compiled_templates.get(template), context)
@@ -0,0 +1,150 @@
+"""
+The JSON encoder and decoder marimo uses for widget data, bulk requests and
+the scripts it writes into pages.
+
+MARIMO_SERIALIZER picks the backend: ``'json'`` (the stdlib),
+``'simplejson'``, ``'ujson'`` or the dotted path of a class with ``dumps``
+and ``loads`` methods. By default simplejson is used if it is installed and
+the stdlib otherwise.
+"""
+from __future__ import absolute_import
+
+import json
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from marimo.utils import smart_import
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONSerializer(object):
+    """ the stdlib json module """
+    name = 'json'
+
+    def __init__(self):
+        self.encoder = json.JSONEncoder()
+
+    def dumps(self, obj):
+        return self.encoder.encode(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class SimpleJSONSerializer(object):
+    """ simplejson, whose C speedups are faster than the stdlib's """
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self.simplejson = simplejson
+        self.encoder = simplejson.JSONEncoder()
+
+    def dumps(self, obj):
+        return self.encoder.encode(obj)
+
+    def loads(self, data):
+        return self.simplejson.loads(data)
+
+
+class UltraJSONSerializer(object):
+    """
+    ujson, the fastest of them. Only used when asked for by name: it rounds
+    floats to fewer digits than the other backends.
+    """
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+
+    def dumps(self, obj):
+        return self.ujson.dumps(obj)
+
+    def loads(self, data):
+        return self.ujson.loads(data)
+
+
+class MsgPackSerializer(object):
+    """
+    MessagePack, a compact binary alternative to JSON for clients that ask
+    for it. It is not a MARIMO_SERIALIZER backend since pages need JSON.
+    """
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def dumps(self, obj):
+        return msgpack.packb(obj)
+
+    def loads(self, data):
+        return msgpack.unpackb(data)
+
+
+BACKENDS = {
+    'json': JSONSerializer,
+    'simplejson': SimpleJSONSerializer,
+    'ujson': UltraJSONSerializer,
+}
+
+
+def get_serializer(name=None):
+    """
+    returns an instance of the serializer called name, or of the fastest
+    safe one installed if name is None
+    """
+    if name is None:
+        try:
+            return SimpleJSONSerializer()
+        except ImportError:
+            return JSONSerializer()
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        try:
+            backend = smart_import(name)
+        except (ImportError, AttributeError, ValueError), e:
+            raise ImproperlyConfigured('unknown marimo serializer %r: %s' % (name, e))
+    try:
+        return backend()
+    except ImportError, e:
+        raise ImproperlyConfigured('marimo serializer %r is not installed: %s' % (name, e))
+
+
+serializer = get_serializer(getattr(settings, 'MARIMO_SERIALIZER', None))
+# None unless msgpack is installed
+msgpack_serializer = msgpack and MsgPackSerializer() or None
+
+
+def dumps(obj):
+    """ obj as a JSON string """
+    return serializer.dumps(obj)
+
+
+def loads(data):
+    """ the object a JSON string holds """
+    return serializer.loads(data)
+
+
+# characters that could end a <script> element or start an html comment in
+# it, with their JSON escapes
+SCRIPT_ESCAPES = (('<', '\\u003c'), ('>', '\\u003e'), ('&', '\\u0026'))
+# line terminators in javascript but not in JSON, as text and as UTF-8
+LINE_ESCAPES = ((u'\u2028', '\\u2028'), (u'\u2029', '\\u2029'))
+UTF8_LINE_ESCAPES = (('\xe2\x80\xa8', '\\u2028'), ('\xe2\x80\xa9', '\\u2029'))
+
+
+def script_dumps(obj):
+    """
+    obj as a JSON string that is safe to embed in a page's <script>: it
+    can't close the element, whatever the data it holds.
+    """
+    data = serializer.dumps(obj)
+    escapes = SCRIPT_ESCAPES + (isinstance(data, unicode) and LINE_ESCAPES or UTF8_LINE_ESCAPES)
+    for char, escape in escapes:
+        data = data.replace(char, escape)
+    return data
@@ -0,0 +1,140 @@
+"""
+A log of individual slow (or randomly sampled) bulk requests, for finding
+out what made a particular request slow.
+
+Every record is one JSON object per line in a rotating file: the bulk
+request's widgets with their args, their kwargs, timings, cache outcomes and
+response sizes. The values of kwargs with sensitive names are redacted; args
+have no names and are logged as they are, so don't pass secrets positionally.
+``manage.py marimo_slow_requests`` summarizes the file.
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import random
+import re
+from logging.handlers import RotatingFileHandler
+
+from django.conf import settings
+
+# kwargs whose names contain any of these words are logged as REDACTED
+DEFAULT_REDACT = ('password', 'passwd', 'secret', 'token', 'auth', 'session',
+                  'sessionid', 'csrf', 'email')
+REDACTED = 'REDACTED'
+
+# the start of every word after the first in a camelCase name
+CAMEL_BOUNDARY = re.compile(r'(?<=[a-z0-9])(?=[A-Z])')
+
+
+def name_words(name):
+    """ name split into lower case words, at underscores and camelCase humps """
+    return CAMEL_BOUNDARY.sub('_', name).lower().split('_')
+
+
+class SlowRequestLog(object):
+    """
+    Writes a record of every bulk request that took at least threshold
+    seconds, and of a sample_rate share of all others.
+
+    :param path: the file to write; None turns the log off
+    :param threshold: seconds above which a request is always recorded;
+        None records only samples
+    :param sample_rate: the share (0 to 1) of other requests recorded
+    :param max_bytes: the size at which the file is rotated
+    :param backups: how many rotated files are kept
+    :param redact: words of kwarg names whose values are not logged; a
+        word matches whole parts of a name, so ``auth`` redacts ``auth`` and
+        ``authToken`` but not ``author``
+    """
+
+    def __init__(self, path=None, threshold=1.0, sample_rate=0.0,
+                 max_bytes=10*1024*1024, backups=5, redact=DEFAULT_REDACT):
+        self.path = path
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        # '_'-delimited so a word only matches whole words of a name
+        self.redact_names = tuple('_%s_' % '_'.join(name_words(name)) for name in redact)
+        self._logger = None
+
+    def wants(self, elapsed):
+        """ True if a request that took elapsed seconds should be recorded """
+        if not self.path:
+            return False
+        if self.threshold is not None and elapsed >= self.threshold:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def redact(self, kwargs):
+        """ a copy of kwargs without the values of sensitive ones """
+        clean = {}
+        for name, value in kwargs.items():
+            words = '_%s_' % '_'.join(name_words(name))
+            if any(redacted in words for redacted in self.redact_names):
+                value = REDACTED
+            clean[name] = value
+        return clean
+
+    def logger(self):
+        """ the logger writing the file, created on first use """
+        if self._logger is None:
+            logger = logging.getLogger('marimo.slow_requests.%s' % os.path.abspath(self.path))
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            if not logger.handlers:
+                handler = RotatingFileHandler(self.path, maxBytes=self.max_bytes,
+                                              backupCount=self.backups)
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                logger.addHandler(handler)
+            self._logger = logger
+        return self._logger
+
+    def write(self, record):
+        """ appends record, a dict, to the log """
+        try:
+            line = json.dumps(record, default=repr)
+        except ValueError:
+            # circular structures in widget args; still log the rest
+            record = dict(record)
+            record['widgets'] = [dict(w, args=repr(w.get('args')), kwargs=repr(w.get('kwargs')))
+                                 for w in record.get('widgets', [])]
+            line = json.dumps(record, default=repr)
+        self.logger().info(line)
+
+
+def read_records(path):
+    """ yields every record in path and its rotated files, oldest file first """
+    paths = []
+    index = 1
+    while os.path.exists('%s.%d' % (path, index)):
+        paths.insert(0, '%s.%d' % (path, index))
+        index += 1
+    if os.path.exists(path):
+        paths.append(path)
+    for name in paths:
+        log = open(name)
+        try:
+            for line in log:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # a partly written line; skip it
+                    continue
+        finally:
+            log.close()
+
+
+slow_log = SlowRequestLog(
+    getattr(settings, 'MARIMO_SLOW_LOG', None),
+    getattr(settings, 'MARIMO_SLOW_THRESHOLD', 1.0),
+    getattr(settings, 'MARIMO_SLOW_SAMPLE_RATE', 0.0),
+    getattr(settings, 'MARIMO_SLOW_LOG_BYTES', 10*1024*1024),
+    getattr(settings, 'MARIMO_SLOW_LOG_BACKUPS', 5),
+    getattr(settings, 'MARIMO_SLOW_REDACT', DEFAULT_REDACT),
+)
@@ -1,5 +1,21 @@
+import hashlib
+import logging
 import os
+import threading
+import time
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
 from django.conf import settings
+from django.utils.encoding import smart_str
+
+from marimo.executor import get_pool
+
+logger = logging.getLogger(__name__)
 
 class TemplateNotFound(Exception):
     """ An exception for when a template can't be found """
@@ -10,31 +26,290 @@ class TemplateLoader(object):
     Loads and caches templates from files
     searches MARIMO_TEMPLATE_DIRS in order
     loads and caches the first template matching the path
+
+    Cached templates are kept in least recently used order and bounded by
+    their total size; the least recently used ones are dropped to make
+    room. Call :meth:`preload` to read every template up front so requests
+    never have to touch the disk.
+
+    With a check_interval, a cached template is compared to its file's
+    mtime at most once every check_interval seconds and reloaded if it
+    changed.
+
+    Templates are looked up in an index of every file under template_dirs
+    (rebuilt on a background thread at most every check_interval seconds),
+    so a path that doesn't exist costs a dict lookup instead of an open()
+    per directory. With
+    use_index off, paths that weren't found are remembered instead, up to
+    max_missing of them.
     """
 
-    def __init__(self):
+    def __init__(self, template_dirs=None, max_bytes=None, check_interval=None,
+                 use_index=None, max_missing=None):
         """ template_dirs is set at __init__ don't try to change them in settings."""
-        self.template_dirs = getattr(settings, 'MARIMO_TEMPLATE_DIRS', [])
-        self._templates = {}
+        if template_dirs is None:
+            template_dirs = getattr(settings, 'MARIMO_TEMPLATE_DIRS', [])
+        if max_bytes is None:
+            max_bytes = getattr(settings, 'MARIMO_TEMPLATE_CACHE_BYTES', 5*1024*1024)
+        if check_interval is None:
+            check_interval = getattr(settings, 'MARIMO_TEMPLATE_CHECK_INTERVAL', None)
+        if use_index is None:
+            use_index = getattr(settings, 'MARIMO_TEMPLATE_INDEX', True)
+        if max_missing is None:
+            max_missing = getattr(settings, 'MARIMO_TEMPLATE_MAX_MISSING', 1000)
+        self.template_dirs = template_dirs
+        self.use_index = use_index
+        self.max_missing = max_missing
+        # relative path -> full paths of the matching files, in template_dirs order
+        self._index = None
+        self._indexed = 0
+        self._index_lock = threading.Lock()
+        self._rebuilding = False
+        # relative path -> time it was found missing
+        self._missing = OrderedDict()
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        # path -> [template, full path, mtime, last checked]
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.negative_hits = 0
 
     def load(self, path):
         """
         load a template
         :param path: The path to the template you want to load from a dir in template_dirs
         """
-        try:
-            return self._templates[path]
-        except KeyError:
-            for directory in self.template_dirs:
-                full = os.path.join(directory, path)
+        entry = self._templates.get(path)
+        if entry is not None:
+            if self.check_interval and entry[3] + self.check_interval <= time.time():
+                entry = self._revalidate(path, entry)
+            if entry is not None:
+                self.hits += 1
+                self._touch(path, entry)
+                return entry[0]
+        self.misses += 1
+        for full in self.find(path):
+            try:
+                fh = open(full)
+            except IOError:
+                pass
+            else:
                 try:
-                    fh = open(full)
-                except IOError:
-                    pass
-                else:
-                    self._templates[path] = fh.read()
+                    template = fh.read()
+                    mtime = os.fstat(fh.fileno()).st_mtime
+                finally:
                     fh.close()
-                    return self._templates[path]
+                self._store(path, [template, full, mtime, time.time()])
+                return template
+        self._remember_missing(path)
         raise TemplateNotFound('No such template: %s' % path)
 
+    def find(self, path):
+        """
+        Returns the full paths that path may be loaded from, best first.
+        Paths that would leave template_dirs never match anything.
+        """
+        path = os.path.normpath(path)
+        if os.path.isabs(path) or path.split(os.sep)[0] == os.pardir:
+            return []
+        if self.use_index:
+            return self.index().get(path, [])
+        missing = self._missing.get(path)
+        if missing is not None:
+            if not self.check_interval or missing + self.check_interval > time.time():
+                self.negative_hits += 1
+                return []
+        return [os.path.join(directory, path) for directory in self.template_dirs]
+
+    def index(self):
+        """
+        The index of every file under template_dirs, built on first use. Once
+        it is older than check_interval it is rebuilt in the background and
+        the old one is used in the meantime.
+        """
+        if self._index is None:
+            # concurrent first requests wait for a single walk
+            self._index_lock.acquire()
+            try:
+                if self._index is None:
+                    self.build_index()
+            finally:
+                self._index_lock.release()
+        elif self.check_interval and self._indexed + self.check_interval <= time.time():
+            self.schedule_index()
+        return self._index
+
+    def build_index(self):
+        """ walks template_dirs and replaces the index """
+        index = {}
+        for directory in self.template_dirs:
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    full = os.path.join(root, name)
+                    index.setdefault(os.path.relpath(full, directory), []).append(full)
+        self._index = index
+        self._indexed = time.time()
+
+    def schedule_index(self):
+        """
+        Rebuilds the index on a background thread. Does nothing if a rebuild
+        is already running. Returns the task, or None if none was scheduled.
+        """
+        self._index_lock.acquire()
+        try:
+            if self._rebuilding:
+                return None
+            self._rebuilding = True
+        finally:
+            self._index_lock.release()
+        task = get_pool('templates', 1, 1).try_submit(self._rebuild_index)
+        if task is None:
+            self._rebuilding = False
+        return task
+
+    def _rebuild_index(self):
+        try:
+            self.build_index()
+        except Exception:
+            logger.exception('rebuilding the marimo template index failed')
+        finally:
+            self._rebuilding = False
+
+    def _remember_missing(self, path):
+        if self.use_index:
+            return
+        self._lock.acquire()
+        try:
+            self._missing.pop(path, None)
+            self._missing[path] = time.time()
+            while len(self._missing) > self.max_missing:
+                self._missing.pop(iter(self._missing).next())
+        finally:
+            self._lock.release()
+
+    def preload(self):
+        """
+        Reads every template under template_dirs into the cache, as long as
+        they fit. Returns the number of templates loaded.
+        """
+        count = 0
+        for path in self.template_paths():
+            try:
+                self.load(path)
+            except TemplateNotFound:
+                continue
+            count += 1
+        return count
+
+    def template_paths(self):
+        """ the relative path of every file under template_dirs """
+        return sorted(self.index())
+
+    def stats(self):
+        """ cache hit/miss counters and memory use """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'reloads': self.reloads,
+            'negative_hits': self.negative_hits,
+            'templates': len(self._templates),
+            'bytes': self.size,
+        }
+
+    def _revalidate(self, path, entry):
+        """
+        Checks a cached template against its file, returning the current
+        entry or None if the file is gone.
+        """
+        try:
+            mtime = os.stat(entry[1]).st_mtime
+        except OSError:
+            self._drop(path)
+            return None
+        if mtime != entry[2]:
+            self._drop(path)
+            self.reloads += 1
+            return None
+        entry[3] = time.time()
+        return entry
+
+    def _store(self, path, entry):
+        size = len(entry[0])
+        self._lock.acquire()
+        try:
+            self._drop_locked(path)
+            if size > self.max_bytes:
+                return
+            self._templates[path] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                self._drop_locked(iter(self._templates).next())
+        finally:
+            self._lock.release()
+
+    def _touch(self, path, entry):
+        """ marks path as the most recently used template """
+        self._lock.acquire()
+        try:
+            if self._templates.pop(path, None) is not None:
+                self._templates[path] = entry
+        finally:
+            self._lock.release()
+
+    def _drop(self, path):
+        self._lock.acquire()
+        try:
+            self._drop_locked(path)
+        finally:
+            self._lock.release()
+
+    def _drop_locked(self, path):
+        entry = self._templates.pop(path, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
 template_loader = TemplateLoader()
+if getattr(settings, 'MARIMO_PRELOAD_TEMPLATES', False):
+    template_loader.preload()
+
+
+def template_hash(template):
+    """ the content hash widgets use to refer to a template """
+    return hashlib.md5(smart_str(template)).hexdigest()
+
+
+class TemplateRegistry(object):
+    """
+    Remembers every template that has been referred to by its content hash
+    in this process, so it can be looked up again by that hash.
+
+    Only templates from handlers and MARIMO_TEMPLATE_DIRS end up here, so
+    it stays as small as the set of templates on disk.
+    """
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def add(self, template):
+        """ registers template and returns its hash """
+        thash = template_hash(template)
+        if thash not in self._templates:
+            self._lock.acquire()
+            try:
+                self._templates[thash] = template
+            finally:
+                self._lock.release()
+        return thash
+
+    def get(self, thash):
+        return self._templates.get(thash)
+
+    def __contains__(self, thash):
+        return thash in self._templates
+
+template_registry = TemplateRegistry()
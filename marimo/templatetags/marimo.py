@@ -1,11 +1,17 @@
-import json
-import random
+from __future__ import absolute_import
+
+import re
 
 from django import template
 from django.conf import settings
 
+from marimo import serializers
+from marimo.utils import widget_id
+
 register = template.Library()
 
+kwarg_re = re.compile(r'^(\w+)=(.+)$')
+
 # TODO allow template tag to accept a string for widget constructor eg AdWidget
 
 @register.tag(name="marimo")
@@ -16,6 +22,9 @@ def marimo(parser, token):
 
         Examples::
             {% marimo comments request_widget objectpk=23 %}
+            {% marimo comments request_widget article.pk|default:0 %}
+
+        args and kwargs are template variables or literals and take filters.
     """
     tokens = token.split_contents()
     if len(tokens) < 3:
@@ -26,46 +35,36 @@ def marimo(parser, token):
     prototype = tokens.pop(0)
     args = []
     kwargs = {}
+    murl = None
 
+    # arguments are compiled once here; rendering only resolves them
     for token in tokens:
-        parts = token.split('=')
-        if len(parts) == 1:
-            args.append(parts[0])
-        elif len(parts) == 2:
-            kwargs[parts[0]] = parts[1]
+        match = kwarg_re.match(token)
+        if not match:
+            args.append(parser.compile_filter(token))
+        elif match.group(1) == 'murl':
+            # murl has always been a literal, quoted or not
+            murl = match.group(2).strip('"\'')
         else:
-            raise template.TemplateSyntaxError('Arguments cannot contain =')
+            kwargs[match.group(1)] = parser.compile_filter(match.group(2))
 
-    return MarimoNode(widget_name, prototype, args, kwargs)
+    return MarimoNode(widget_name, prototype, args, kwargs, murl)
 
 class MarimoNode(template.Node):
-    def __init__(self, widget_name, prototype, args, kwargs):
+    def __init__(self, widget_name, prototype, args, kwargs, murl=None):
         self.widget_name = widget_name
         self.prototype = prototype
         self.args = args
         self.kwargs = kwargs
+        self.murl = murl
 
     def render(self, context):
-        if 'murl' in self.kwargs:
-            murl = self.kwargs.pop('murl')
-        else:
-            murl = settings.MARIMO_URL
-
-        def maybe_resolve(arg):
-            if arg[0] == '"' and arg[-1] == '"':
-                return arg.strip('"')
-            else:
-                var = template.Variable(arg)
-                return var.resolve(context)
-
         data = {}
-        data['kwargs'] = {}
-        for (k, v) in self.kwargs.items():
-            data['kwargs'][k] = maybe_resolve(v)
-        data['args'] = [maybe_resolve(arg) for arg in self.args]
+        data['kwargs'] = dict((k, v.resolve(context)) for (k, v) in self.kwargs.items())
+        data['args'] = [arg.resolve(context) for arg in self.args]
         data['widget_name'] = self.widget_name
-        data['id'] = self.generate_id()
-        data['murl'] = murl
+        data['murl'] = self.murl or settings.MARIMO_URL
+        data['id'] = self.generate_id(context, data)
         data['widget_prototype'] = self.prototype
 
         divstr = '<div id="{id}" class="{cls}"></div>'.format(
@@ -81,11 +80,11 @@ class MarimoNode(template.Node):
                 context['marimo_widgets'].append(data)
             script = ''
         else:
-            script = '<script> marimo.add_widget(%s); </script>' % json.dumps(data)
+            script = '<script> marimo.add_widget(%s); </script>' % serializers.dumps(data)
 
         return divstr + script
 
-    def generate_id(self):
-        """ a widget's id is its name + a randint """
-        # hopefully this is adequate
-        return '%s_%s' % (self.widget_name, str(random.randint(0,999999)))
+    def generate_id(self, context, data):
+        """ a widget's id is its name + a hash of what it renders """
+        return widget_id(context, self.widget_name + '_', self.prototype,
+                         data['args'], data['kwargs'], data['murl'])
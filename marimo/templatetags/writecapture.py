@@ -1,8 +1,10 @@
-import json
-import random
+from __future__ import absolute_import
 
 from django import template
 
+from marimo import serializers
+from marimo.utils import widget_id
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -34,8 +36,9 @@ def write_capture(parser, token):
         need to use this if you have subclassed marimo's built-in writecapture
         widget and want to use that instead.
 
-        The ``widget_id`` argument defaults to a 'writecapture_<randomnumber>.'
-        Use this only if you need to specify an alternate element id in the DOM
+        The ``widget_id`` argument defaults to 'writecapture<hash>', where the
+        hash is of the prototype and content, so identical renders get the
+        same id. Use this only if you need to specify an alternate element id in the DOM
         to write to (otherwise one will be created for you at the site of the
         {%writecapture%} invocation)..
 
@@ -66,24 +69,27 @@ class WriteCaptureNode(template.Node):
         self.script_filter = script_filter
         self.prototype = prototype
         self.widget_id = widget_id
-        if not self.widget_id:
-            self.widget_id = 'writecapture' + str(random.randint(0,99999999))
 
     def render(self, context):
         eviloutput = jsescape(self.nodelist.render(context))
-        if isinstance(self.script_filter, template.Variable):
-            self.script_filter = bool(self.script_filter.resolve(context))
+        script_filter = self.script_filter
+        if isinstance(script_filter, template.Variable):
+            script_filter = bool(script_filter.resolve(context))
         # Set this flag in your template tag for advanced write capture widget sanitation.
         # Source: https://github.com/iamnoah/writeCapture/wiki/Usage
 
         global_compatibility_mode = context.get('wc_compatibility_mode', None)
         if global_compatibility_mode is None:
-            wc_compatibility_mode = self.script_filter
+            wc_compatibility_mode = script_filter
         else:
             wc_compatibility_mode = global_compatibility_mode
 
+        # picked per render, not at parse time, so cached templates don't
+        # share an id between renders
+        dom_id = self.widget_id or widget_id(context, 'writecapture', self.prototype,
+                                             eviloutput, wc_compatibility_mode)
         widget_dict = dict(widget_prototype=self.prototype,
-                            id=self.widget_id,
+                            id=dom_id,
                             html=eviloutput,
                             wc_compatibility_mode = wc_compatibility_mode,
                          )
@@ -93,8 +99,8 @@ class WriteCaptureNode(template.Node):
     marimo.add_widget({widget_json});
 </script>"""
         output = output.format(
-            widget_id=self.widget_id,
-            widget_json=json.dumps(widget_dict),
+            widget_id=dom_id,
+            widget_json=serializers.dumps(widget_dict),
         )
         return output
 
@@ -117,83 +123,10 @@ class WriteCaptureDelayNode(template.Node):
 
     def render(self, context):
         output = ''
-        if self.event is None:
-            self.event = 'write_' + str(random.randint(0,999999))
-            output = """<script type="text/javascript">marimo.emit('%s');</script>""" % self.event
-
-        # this should only be used once per page if it's uses a second time
-        # overwrite but log an error
-        wc_delay = context.get('marimo_writecapture_delay', None)
-        if not wc_delay:
-            logger.error("The writecapture_delay was called but didn't find "
-                         "marimo_writecapture_delay in the context. The tag "
-                         "depends on the Marimo middleware and context_processor.")
-            return output
-        if wc_delay.marimo_event:
-            logger.error('Overwriting the marimo event delay %s with %s' %
-                         (wc_delay.marimo_event, self.event))
-        wc_delay.marimo_event = self.event
-        return output
-
-@register.tag(name='writecapture_delay')
-def write_capture_delay(parser, token):
-    """
-        Syntax::
-            {% writecapture_delay [event_name] %}
-    """
-    tokens = token.split_contents()
-    if len(tokens) > 2:
-        raise template.TemplateSyntaxError("writecapture_delay takes at most 1 argument")
-    if len(tokens) == 2:
-        return WriteCaptureDelayNode(tokens[1])
-    return WriteCaptureDelayNode()
-
-class WriteCaptureDelayNode(template.Node):
-    def __init__(self, event=None):
-        self.event = event
-
-    def render(self, context):
-        output = ''
-        if self.event is None:
-            self.event = 'write_' + str(random.randint(0,999999))
-            output = """<script type="text/javascript">marimo.emit('%s');</script>""" % self.event
-
-        # this should only be used once per page if it's uses a second time
-        # overwrite but log an error
-        wc_delay = context.get('marimo_writecapture_delay', None)
-        if not wc_delay:
-            logger.error("The writecapture_delay was called but didn't find "
-                         "marimo_writecapture_delay in the context. The tag "
-                         "depends on the Marimo middleware and context_processor.")
-            return output
-        if wc_delay.marimo_event:
-            logger.error('Overwriting the marimo event delay %s with %s' %
-                         (wc_delay.marimo_event, self.event))
-        wc_delay.marimo_event = self.event
-        return output
-
-@register.tag(name='writecapture_delay')
-def write_capture_delay(parser, token):
-    """
-        Syntax::
-            {% writecapture_delay [event_name] %}
-    """
-    tokens = token.split_contents()
-    if len(tokens) > 2:
-        raise template.TemplateSyntaxError("writecapture_delay takes at most 1 argument")
-    if len(tokens) == 2:
-        return WriteCaptureDelayNode(tokens[1])
-    return WriteCaptureDelayNode()
-
-class WriteCaptureDelayNode(template.Node):
-    def __init__(self, event=None):
-        self.event = event
-
-    def render(self, context):
-        output = ''
-        if self.event is None:
-            self.event = 'write_' + str(random.randint(0,999999))
-            output = """<script type="text/javascript">marimo.emit('%s');</script>""" % self.event
+        event = self.event
+        if event is None:
+            event = widget_id(context, 'write_', 'writecapture_delay')
+            output = """<script type="text/javascript">marimo.emit('%s');</script>""" % event
 
         # this should only be used once per page if it's uses a second time
         # overwrite but log an error
@@ -205,6 +138,6 @@ class WriteCaptureDelayNode(template.Node):
             return output
         if wc_delay.marimo_event:
             logger.error('Overwriting the marimo event delay %s with %s' %
-                         (wc_delay.marimo_event, self.event))
-        wc_delay.marimo_event = self.event
+                         (wc_delay.marimo_event, event))
+        wc_delay.marimo_event = event
         return output
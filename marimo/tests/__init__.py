@@ -1,3 +1,8 @@
-from marimo.tests.test_views import TestRouterView, TestBaseView
+from marimo.tests.test_views import TestRouterView, TestBaseView, TestRegistry
 from marimo.tests.test_tags import TestTag
 from marimo.tests.test_middleware import TestMiddleware, TestContextProcessor
+from marimo.tests.test_local_cache import TestLocalCache
+from marimo.tests.test_template_loader import TestTemplateLoader
+from marimo.tests.test_serializers import TestSerializers
+from marimo.tests.test_metrics import TestMetrics
+from marimo.tests.test_slow_log import TestSlowLog
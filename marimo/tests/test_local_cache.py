@@ -0,0 +1,50 @@
+import time
+
+from unittest2 import TestCase
+
+from marimo.local_cache import LocalCache
+
+
+class TestLocalCache(TestCase):
+    def setUp(self):
+        self.cache = LocalCache(max_entries=3, max_bytes=1024)
+
+    def test_get_returns_copy(self):
+        value = {'context': {'name': 'nate'}}
+        self.cache.set('key', value, 10)
+        got = self.cache.get('key')
+        self.assertEqual(got, value)
+        got['context']['name'] = 'changed'
+        self.assertEqual(self.cache.get('key'), value)
+
+    def test_expired(self):
+        self.cache.set('key', 'value', -1)
+        self.assertEqual(self.cache.get('key'), None)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_evicts_least_recently_used(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, key, 10)
+        self.cache.get('a')
+        self.cache.set('d', 'd', 10)
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get_many(['a', 'c', 'd']),
+                         {'a': 'a', 'c': 'c', 'd': 'd'})
+
+    def test_bounded_by_bytes(self):
+        self.cache.set('a', 'x' * 600, 10)
+        self.cache.set('b', 'x' * 600, 10)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertTrue(self.cache.size <= 1024)
+        # too big to ever fit
+        self.cache.set('c', 'x' * 2000, 10)
+        self.assertEqual(self.cache.get('c'), None)
+        self.assertEqual(self.cache.get('b'), 'x' * 600)
+
+    def test_delete(self):
+        self.cache.set('key', 'value', 10)
+        self.cache.delete('key')
+        self.cache.delete('key')
+        self.assertEqual(self.cache.get('key'), None)
+        self.assertEqual(self.cache.size, 0)
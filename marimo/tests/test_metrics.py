@@ -0,0 +1,30 @@
+from django.core.exceptions import ImproperlyConfigured
+from unittest2 import TestCase
+
+import mock
+
+from marimo.metrics import LoggingMetrics, get_metrics
+
+
+class TestMetrics(TestCase):
+    def test_default(self):
+        self.assertTrue(isinstance(get_metrics(), LoggingMetrics))
+
+    def test_dotted_path(self):
+        self.assertTrue(isinstance(get_metrics('marimo.metrics.LoggingMetrics'), LoggingMetrics))
+
+    def test_unknown(self):
+        self.assertRaises(ImproperlyConfigured, get_metrics, 'marimo.nope.Metrics')
+
+    def test_logging(self):
+        metrics = LoggingMetrics()
+        metrics.logger = mock.Mock()
+        metrics.logger.isEnabledFor.return_value = True
+        metrics.widget_timing('comments', 'c1', 'hit',
+                              {'cacheable': None, 'uncacheable': 0.002, 'total': 0.002})
+        self.assertEqual(metrics.logger.debug.call_args[0][1:],
+                         ('comments', 'c1', 'hit', 'cacheable=- uncacheable=2.0ms total=2.0ms'))
+
+        metrics.logger.isEnabledFor.return_value = False
+        metrics.widget_timing('comments', 'c1', 'hit', {})
+        self.assertEqual(metrics.logger.debug.call_count, 1)
@@ -1,8 +1,9 @@
 import mock
 
+from django.http import HttpResponse
 from unittest2 import TestCase
 
-from marimo.middleware import MarimoEventContainer, Marimo, context_processor
+from marimo.middleware import MarimoEventContainer, Marimo, context_processor, EMPTY_CODE
 
 
 class TestMiddleware(TestCase):
@@ -27,8 +28,7 @@ class TestMiddleware(TestCase):
         req = mock.Mock()
         req.marimo_writecapture_delay = MarimoEventContainer()
         req.marimo_widgets = ['dummywidget']
-        resp = mock.Mock()
-        resp.content = "dummytext ${MARIMO} moredumbtext"
+        resp = HttpResponse("dummytext ${MARIMO} moredumbtext")
         self.middleware.process_response(req, resp)
         self.assertTrue("dummywidget" in resp.content)
 
@@ -36,11 +36,137 @@ class TestMiddleware(TestCase):
         req = mock.Mock()
         req.marimo_widgets = []
         req.marimo_writecapture_delay = MarimoEventContainer("documentready")
-        resp = mock.Mock()
-        resp.content = "dummytext ${MARIMO} moredumbtext"
+        resp = HttpResponse("dummytext ${MARIMO} moredumbtext")
         self.middleware.process_response(req, resp)
         self.assertTrue("documentready" in resp.content)
 
+    def test_process_response_skips_other_content_types(self):
+        req = mock.Mock()
+        req.marimo_writecapture_delay = MarimoEventContainer()
+        req.marimo_widgets = ['dummywidget']
+        resp = HttpResponse('{"a": "${MARIMO}"}', content_type='application/json')
+        self.middleware.process_response(req, resp)
+        self.assertEqual(resp.content, '{"a": "${MARIMO}"}')
+
+    @mock.patch('marimo.middleware.serializers')
+    def test_process_response_nothing_registered(self, mock_json):
+        req = mock.Mock()
+        req.marimo_writecapture_delay = MarimoEventContainer()
+        req.marimo_widgets = []
+        resp = HttpResponse("a ${MARIMO} b ${MARIMO}")
+        self.middleware.process_response(req, resp)
+        self.assertFalse(mock_json.dumps.called)
+        self.assertEqual(resp.content, "a %s b %s" % (EMPTY_CODE, EMPTY_CODE))
+
+    def test_process_response_content_length(self):
+        req = mock.Mock()
+        req.marimo_writecapture_delay = MarimoEventContainer()
+        req.marimo_widgets = ['dummywidget']
+        resp = HttpResponse("dummytext ${MARIMO} moredumbtext")
+        resp['Content-Length'] = str(len(resp.content))
+        self.middleware.process_response(req, resp)
+        self.assertEqual(resp['Content-Length'], str(len(resp.content)))
+
+    def test_process_response_streaming(self):
+        req = mock.Mock()
+        req.marimo_writecapture_delay = MarimoEventContainer()
+        req.marimo_widgets = ['dummywidget']
+        consumed = []
+
+        def chunks():
+            for chunk in ["<head>${MA", "RIMO}</head>", "<body>$", "{MARIMO}", "</body>"]:
+                consumed.append(chunk)
+                yield chunk
+        resp = HttpResponse(chunks())
+        resp['Content-Length'] = '1000'
+        self.middleware.process_response(req, resp)
+        self.assertFalse(resp.has_header('Content-Length'))
+        self.assertEqual(consumed, [])
+
+        body = iter(resp)
+        self.assertEqual(body.next(), "<head>")
+        # nothing past the chunk being rewritten has been read
+        self.assertEqual(len(consumed), 1)
+        rest = ''.join(body)
+        code = 'marimo.add_widgets(["dummywidget"]);'
+        self.assertEqual(rest, "%s</head><body>%s</body>" % (code, code))
+
+    @mock.patch('marimo.middleware.MARIMO_INLINE', 'all')
+    @mock.patch('marimo.middleware.MarimoRouter')
+    def test_process_response_inline(self, mock_router):
+        mock_router.return_value.prefetch.return_value = ({'w1': {'html': 'hi'}}, 'no-cache')
+        req = mock.Mock()
+        req.marimo_writecapture_delay = MarimoEventContainer()
+        req.marimo_widgets = [{'id': 'w1', 'widget_name': 'a'},
+                              {'id': 'w2', 'widget_name': 'b'}]
+        resp = HttpResponse("dummytext ${MARIMO} moredumbtext")
+        self.middleware.process_response(req, resp)
+        prefetch = mock_router.return_value.prefetch
+        self.assertEqual(prefetch.call_args[1], {'selected_only': False, 'skip_nocache': False})
+        self.assertTrue('"response": {"html": "hi"}' in resp.content)
+        self.assertEqual(resp.content.count('"response"'), 1)
+        self.assertEqual(resp['Cache-Control'], 'no-cache')
+        # the registered widgets themselves are left alone
+        self.assertFalse('response' in req.marimo_widgets[0])
+
+    @mock.patch('marimo.middleware.MARIMO_INLINE', 'all')
+    @mock.patch('marimo.middleware.MarimoRouter')
+    def test_process_response_inline_escaped(self, mock_router):
+        # handler output is user data; it must not close the page's script
+        evil = '</script><script>alert(1)</script>'
+        mock_router.return_value.prefetch.return_value = ({'w1': {'context': {'body': evil}}}, None)
+        req = mock.Mock()
+        req.marimo_writecapture_delay = MarimoEventContainer()
+        req.marimo_widgets = [{'id': 'w1', 'widget_name': 'a'}]
+        resp = HttpResponse("<script>${MARIMO}</script>")
+        self.middleware.process_response(req, resp)
+        self.assertFalse(evil in resp.content)
+        self.assertEqual(resp.content.count('</script>'), 1)
+        self.assertTrue('\\u003c/script\\u003e' in resp.content)
+
+    @mock.patch('marimo.middleware.MARIMO_INLINE', 'all')
+    @mock.patch('marimo.middleware.MarimoRouter')
+    def test_process_response_inline_streaming(self, mock_router):
+        # the headers are sent before the script is built, so widgets that
+        # need no-cache must not be inlined
+        mock_router.return_value.prefetch.return_value = ({}, None)
+        req = mock.Mock()
+        req.marimo_writecapture_delay = MarimoEventContainer()
+        req.marimo_widgets = [{'id': 'w1', 'widget_name': 'a'}]
+        resp = HttpResponse(iter(["a ${MARIMO} b"]))
+        self.middleware.process_response(req, resp)
+        ''.join(resp)
+        prefetch = mock_router.return_value.prefetch
+        self.assertEqual(prefetch.call_args[1], {'selected_only': False, 'skip_nocache': True})
+
+    @mock.patch('marimo.middleware.MarimoRouter')
+    def test_process_response_inline_off(self, mock_router):
+        req = mock.Mock()
+        req.marimo_writecapture_delay = MarimoEventContainer()
+        req.marimo_widgets = [{'id': 'w1', 'widget_name': 'a'}]
+        resp = HttpResponse("dummytext ${MARIMO} moredumbtext")
+        self.middleware.process_response(req, resp)
+        self.assertFalse(mock_router.called)
+
+    @mock.patch('marimo.middleware.MARIMO_PREFETCH', True)
+    @mock.patch('marimo.middleware.MARIMO_INLINE', 'all')
+    @mock.patch('marimo.middleware.get_pool')
+    @mock.patch('marimo.middleware.MarimoRouter')
+    def test_process_response_prefetch(self, mock_router, mock_get_pool):
+        mock_router.return_value.prefetch.return_value = ({'w1': {'html': 'hi'}}, None)
+        req = mock.Mock()
+        req.marimo_writecapture_delay = MarimoEventContainer()
+        req.marimo_widgets = [{'id': 'w1', 'widget_name': 'a'},
+                              {'id': 'w2', 'widget_name': 'b'}]
+        resp = HttpResponse("dummytext ${MARIMO} moredumbtext")
+        self.middleware.process_response(req, resp)
+        # only what wasn't inlined is warmed, without waiting for it
+        try_submit = mock_get_pool.return_value.try_submit
+        self.assertEqual(try_submit.call_count, 1)
+        self.assertEqual(try_submit.call_args[0][1:],
+                         (req, [{'id': 'w2', 'widget_name': 'b'}]))
+
+
 class TestContextProcessor(TestCase):
     def setUp(self):
         self.request = mock.Mock()
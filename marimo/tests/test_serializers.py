@@ -0,0 +1,81 @@
+import json
+
+import mock
+from django.core.exceptions import ImproperlyConfigured
+from unittest2 import TestCase, skipIf
+
+from marimo.serializers import (JSONSerializer, MsgPackSerializer, get_serializer, msgpack,
+                                script_dumps)
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class UpperSerializer(JSONSerializer):
+    def dumps(self, obj):
+        return super(UpperSerializer, self).dumps(obj).upper()
+
+
+class UTF8Serializer(JSONSerializer):
+    def dumps(self, obj):
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+class TestSerializers(TestCase):
+    data = [{'id': 'w1', 'context': {'name': u'caf\xe9', 'n': 1.5}, 'args': [1, None, True]}]
+
+    def test_json(self):
+        serializer = get_serializer('json')
+        self.assertEqual(serializer.loads(serializer.dumps(self.data)), self.data)
+
+    @skipIf(simplejson is None, 'simplejson is not installed')
+    def test_simplejson(self):
+        serializer = get_serializer('simplejson')
+        self.assertEqual(serializer.loads(serializer.dumps(self.data)), self.data)
+
+    @skipIf(ujson is None, 'ujson is not installed')
+    def test_ujson(self):
+        serializer = get_serializer('ujson')
+        self.assertEqual(serializer.loads(serializer.dumps(self.data)), self.data)
+
+    @skipIf(ujson is not None, 'ujson is installed')
+    def test_not_installed(self):
+        self.assertRaises(ImproperlyConfigured, get_serializer, 'ujson')
+
+    def test_default(self):
+        expected = simplejson and 'simplejson' or 'json'
+        self.assertEqual(get_serializer().name, expected)
+
+    def test_dotted_path(self):
+        serializer = get_serializer('marimo.tests.test_serializers.UpperSerializer')
+        self.assertEqual(serializer.dumps(['a']), '["A"]')
+
+    def test_unknown(self):
+        self.assertRaises(ImproperlyConfigured, get_serializer, 'nope')
+        self.assertRaises(ImproperlyConfigured, get_serializer, 'marimo.tests.Nope')
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        serializer = MsgPackSerializer()
+        data = [{'id': 'w1', 'context': {'n': 1.5}, 'args': [1, None, True]}]
+        self.assertEqual(serializer.loads(serializer.dumps(data)), data)
+
+    def test_script_dumps(self):
+        data = {'html': u'</script><script>alert(1)</script><!-- & \u2028\u2029'}
+        dumped = script_dumps(data)
+        for char in ('<', '>', '&', u'\u2028', u'\u2029'):
+            self.assertFalse(char in dumped)
+        self.assertEqual(get_serializer('json').loads(dumped), data)
+
+    def test_script_dumps_utf8(self):
+        utf8 = UTF8Serializer()
+        with mock.patch('marimo.serializers.serializer', utf8):
+            dumped = script_dumps([u'a\u2028</b>'])
+        self.assertEqual(dumped, '["a\\u2028\\u003c/b\\u003e"]')
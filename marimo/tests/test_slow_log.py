@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.core.management import call_command
+from unittest2 import TestCase
+
+import mock
+
+from marimo.slow_log import REDACTED, SlowRequestLog, read_records
+from marimo.tests.test_views import widgets
+from marimo.views import MarimoRouter
+
+
+class TestSlowLog(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'slow.log')
+        self.log = SlowRequestLog(self.path, threshold=0.5, sample_rate=0.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_wants(self):
+        self.assertTrue(self.log.wants(0.5))
+        self.assertFalse(self.log.wants(0.1))
+        self.log.sample_rate = 1.0
+        self.assertTrue(self.log.wants(0.1))
+        self.assertFalse(SlowRequestLog(None, threshold=0).wants(1))
+
+    def test_redact(self):
+        clean = self.log.redact({'objectpk': 23, 'userPassword': 'x', 'api_token': 'y'})
+        self.assertEqual(clean, {'objectpk': 23, 'userPassword': REDACTED, 'api_token': REDACTED})
+        # whole words only: 'auth' must not swallow 'author'
+        clean = self.log.redact({'author': 'a', 'author_id': 1, 'auth_token': 'x',
+                                 'authKey': 'y', 'user_email': 'z'})
+        self.assertEqual(clean, {'author': 'a', 'author_id': 1, 'auth_token': REDACTED,
+                                 'authKey': REDACTED, 'user_email': REDACTED})
+        log = SlowRequestLog(self.path, redact=('api_key',))
+        self.assertEqual(log.redact({'api_key': 'x', 'my_api_key': 'y', 'key': 1}),
+                         {'api_key': REDACTED, 'my_api_key': REDACTED, 'key': 1})
+
+    def test_write_and_read(self):
+        self.log.write({'elapsed': 1, 'widgets': []})
+        self.log.write({'elapsed': 2, 'widgets': []})
+        self.assertEqual([r['elapsed'] for r in read_records(self.path)], [1, 2])
+
+    def test_rotation(self):
+        self.log.max_bytes = 100
+        self.log.backups = 2
+        for i in range(10):
+            self.log.write({'elapsed': i, 'padding': 'x' * 60})
+        self.assertTrue(os.path.exists(self.path + '.1'))
+        self.assertFalse(os.path.exists(self.path + '.3'))
+        elapsed = [r['elapsed'] for r in read_records(self.path)]
+        self.assertEqual(elapsed, sorted(elapsed))
+        self.assertEqual(elapsed[-1], 9)
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    def test_router_records_slow_requests(self):
+        request = mock.Mock()
+        request.META = {}
+        request.path = '/marimo/'
+        request.GET = {'bulk': '[...]'}
+        bulk = [
+                {'id':'1', 'widget_name':'slow', 'args':[0.01], 'kwargs':{'session_id': 'abc'}},
+                {'id':'2', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+        ]
+        self.log.threshold = 0.005
+        with mock.patch('marimo.views.router.slow_log', self.log):
+            MarimoRouter().route(request, bulk)
+        record = list(read_records(self.path))[0]
+        self.assertTrue(record['elapsed'] >= 0.01)
+        self.assertEqual(record['request_bytes'], 5)
+        self.assertTrue(record['response_bytes'] > 0)
+        slow = record['widgets'][0]
+        self.assertEqual(slow['widget_name'], 'slow')
+        self.assertEqual(slow['kwargs'], {'session_id': REDACTED})
+        self.assertEqual(slow['status'], 'succeeded')
+        self.assertTrue(slow['timings']['uncacheable'] >= 0.01)
+        self.assertTrue(slow['bytes'] > 0)
+
+    def test_command(self):
+        for elapsed in (0.2, 0.9):
+            self.log.write({'elapsed': elapsed, 'widgets': [
+                {'widget_name': 'fast', 'status': 'succeeded', 'cache': 'hit', 'bytes': 10,
+                 'timings': {'cacheable': None, 'uncacheable': 0.01, 'total': 0.01}},
+                {'widget_name': 'slow', 'status': 'succeeded', 'cache': 'miss', 'bytes': 20,
+                 'timings': {'cacheable': 0.1, 'uncacheable': 0.05, 'total': 0.15}},
+            ]})
+        out = StringIO()
+        call_command('marimo_slow_requests', path=self.path, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('2 requests'))
+        # worst first
+        self.assertTrue(lines[3].startswith('slow '))
+        self.assertTrue(lines[4].startswith('fast '))
+        self.assertTrue('100.0' in lines[3])
@@ -55,6 +55,54 @@ class TestTag(TestCase):
         t.render(self.context)
         self.assertEquals(len(self.context['marimo_widgets']), 1)
 
+    def test_marimo_tag_ids_are_stable(self):
+        t = template.Template("""{% load marimo %}{% marimo test proto "a" %}{% marimo test proto "a" %}{% marimo test proto "b" %}""")
+        settings.MARIMO_FAST = False
+        first = t.render(self.context)
+        ids = re.findall(r'<div id="([^"]+)"', first)
+        # identical widgets still get distinct ids
+        self.assertEqual(len(set(ids)), 3)
+        self.assertEqual(ids[1], ids[0] + '_1')
+        # and a second render of the page is byte identical
+        self.assertEqual(t.render(template.Context()), first)
+
+    def test_marimo_tag_ids_count_across_includes(self):
+        inner = template.Template("""{% load marimo %}{% marimo test proto "a" %}""")
+        t = template.Template("""{% load marimo %}{% marimo test proto "a" %}{% include inc %}""")
+        settings.MARIMO_FAST = False
+        self.context['inc'] = 'inc.html'
+        with patch('django.template.loader_tags.get_template', return_value=inner):
+            ids = re.findall(r'<div id="([^"]+)"', t.render(self.context))
+        self.assertEqual(ids, [ids[0], ids[0] + '_1'])
+
+    def test_marimo_tag_ids_count_per_request(self):
+        t = template.Template("""{% load marimo %}{% marimo test proto "a" %}""")
+        settings.MARIMO_FAST = False
+        self.context['marimo_ids'] = {}
+        first = re.findall(r'<div id="([^"]+)"', t.render(self.context))[0]
+        # an include rendering the same widget later in the request
+        second = re.findall(r'<div id="([^"]+)"', t.render(self.context))[0]
+        self.assertEqual(second, first + '_1')
+
+    def test_marimo_tag_filters(self):
+        t = template.Template("""{% load marimo %}{% marimo test proto name|upper 'single' k1=missing|default:"fallback" %}""")
+        settings.MARIMO_FAST = True
+        self.context['name'] = 'incon'
+        t.render(self.context)
+        data = self.context['marimo_widgets'][0]
+        self.assertEqual(data['args'], ['INCON', 'single'])
+        self.assertEqual(data['kwargs'], {'k1': 'fallback'})
+
+    def test_marimo_tag_murl(self):
+        t = template.Template("""{% load marimo %}{% marimo test proto murl=http://other.com/ %}""")
+        settings.MARIMO_FAST = True
+        t.render(self.context)
+        t.render(self.context)
+        # murl is not used up by the first render
+        self.assertEqual([w['murl'] for w in self.context['marimo_widgets']],
+                         ['http://other.com/', 'http://other.com/'])
+        self.assertFalse('murl' in self.context['marimo_widgets'][0]['kwargs'])
+
     def test_writecapture_delay_tag_no_args(self):
         t = template.Template("""{% load writecapture %} {% writecapture_delay %}""")
         t.render(self.context)
@@ -154,6 +202,15 @@ class TestWritecaptureTag(TestCase):
         self.assertScriptFilterOff(output)
         self.assertPrototype('some_prototype', output)
 
+    def test_writecapture_tag_id_per_render(self):
+        node = self.run()
+        node.nodelist.render.return_value = 'one'
+        first = node.render(template.Context())
+        self.assertEqual(node.render(template.Context()), first)
+        node.nodelist.render.return_value = 'two'
+        self.assertNotEqual(node.render(template.Context()), first)
+        self.assertEqual(node.widget_id, None)
+
     @patch('marimo.templatetags.writecapture.jsescape', mock_jsescape)
     def test_writecapture_tag_three_args(self):
         output = self.run('False', 'some_prototype', 'dealWithIt').render(self.stub_context)
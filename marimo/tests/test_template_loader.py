@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import mock
+from unittest2 import TestCase
+
+from marimo.template_loader import TemplateLoader, TemplateNotFound
+
+
+class TestTemplateLoader(TestCase):
+    def setUp(self):
+        self.first = tempfile.mkdtemp()
+        self.second = tempfile.mkdtemp()
+        self.write(self.first, 'a.html', 'first a')
+        self.write(self.second, 'a.html', 'second a')
+        self.write(self.second, os.path.join('sub', 'b.html'), 'second b')
+        self.write(self.first, 'c.html', 'c')
+        self.loader = TemplateLoader([self.first, self.second])
+
+    def tearDown(self):
+        shutil.rmtree(self.first)
+        shutil.rmtree(self.second)
+
+    def write(self, directory, path, content, mtime=None):
+        full = os.path.join(directory, path)
+        if not os.path.isdir(os.path.dirname(full)):
+            os.makedirs(os.path.dirname(full))
+        fh = open(full, 'w')
+        fh.write(content)
+        fh.close()
+        if mtime is not None:
+            os.utime(full, (mtime, mtime))
+
+    def test_load_first_match(self):
+        self.assertEqual(self.loader.load('a.html'), 'first a')
+        self.assertEqual(self.loader.load(os.path.join('sub', 'b.html')), 'second b')
+        self.assertRaises(TemplateNotFound, self.loader.load, 'nope.html')
+
+    def test_stats(self):
+        self.loader.load('a.html')
+        self.loader.load('a.html')
+        stats = self.loader.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['templates'], 1)
+        self.assertEqual(stats['bytes'], len('first a'))
+
+    def test_preload(self):
+        self.assertEqual(self.loader.preload(), 3)
+        self.write(self.first, 'a.html', 'changed')
+        # served from memory without looking at the file again
+        self.assertEqual(self.loader.load('a.html'), 'first a')
+        self.assertEqual(self.loader.stats()['misses'], 3)
+
+    def test_revalidate_by_mtime(self):
+        self.loader.check_interval = -1
+        self.write(self.first, 'a.html', 'first a', mtime=1000)
+        self.assertEqual(self.loader.load('a.html'), 'first a')
+        self.write(self.first, 'a.html', 'changed', mtime=2000)
+        self.assertEqual(self.loader.load('a.html'), 'changed')
+        self.assertEqual(self.loader.stats()['reloads'], 1)
+        os.remove(os.path.join(self.first, 'a.html'))
+        self.assertEqual(self.loader.load('a.html'), 'second a')
+
+    def test_bounded_memory(self):
+        self.loader.max_bytes = len('first a') + len('second b')
+        self.loader.load('a.html')
+        self.loader.load(os.path.join('sub', 'b.html'))
+        self.loader.load('c.html')
+        self.assertTrue(self.loader.size <= self.loader.max_bytes)
+        self.assertEqual(self.loader.stats()['templates'], 2)
+
+    def test_misses_use_index(self):
+        self.loader.index()
+        with mock.patch('__builtin__.open') as mock_open:
+            self.assertRaises(TemplateNotFound, self.loader.load, 'nope.html')
+            self.assertRaises(TemplateNotFound, self.loader.load, '../a.html')
+        self.assertFalse(mock_open.called)
+
+    def test_index_refreshed_after_check_interval(self):
+        self.loader.index()
+        self.write(self.first, 'new.html', 'new')
+        self.assertRaises(TemplateNotFound, self.loader.load, 'new.html')
+        self.loader.check_interval = -1
+        # the rebuild runs in the background; requests keep the old index
+        with mock.patch('marimo.template_loader.get_pool') as get_pool:
+            self.assertRaises(TemplateNotFound, self.loader.load, 'new.html')
+            # only one rebuild is scheduled at a time
+            self.assertRaises(TemplateNotFound, self.loader.load, 'new.html')
+        self.assertEqual(get_pool.return_value.try_submit.call_count, 1)
+        self.loader._rebuild_index()
+        self.assertEqual(self.loader.load('new.html'), 'new')
+
+    def test_index_rebuilt_in_background(self):
+        self.loader.index()
+        self.write(self.first, 'new.html', 'new')
+        self.loader.check_interval = -1
+        self.loader.schedule_index().wait(1)
+        self.assertTrue('new.html' in self.loader.index())
+
+    def test_first_index_built_once(self):
+        walks = []
+        real_walk = os.walk
+        def slow_walk(directory, *args):
+            if not args:
+                # os.walk recurses through os.walk with more arguments
+                walks.append(directory)
+                time.sleep(0.01)
+            return real_walk(directory, *args)
+        with mock.patch('os.walk', slow_walk):
+            threads = [threading.Thread(target=self.loader.index) for i in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(walks, [self.first, self.second])
+
+    def test_negative_cache_without_index(self):
+        self.loader.use_index = False
+        self.loader.max_missing = 1
+        self.assertRaises(TemplateNotFound, self.loader.load, 'nope.html')
+        with mock.patch('__builtin__.open') as mock_open:
+            self.assertRaises(TemplateNotFound, self.loader.load, 'nope.html')
+        self.assertFalse(mock_open.called)
+        self.assertEqual(self.loader.stats()['negative_hits'], 1)
+        # bounded: remembering another miss forgets the first
+        self.assertRaises(TemplateNotFound, self.loader.load, 'other.html')
+        self.assertEqual(self.loader.find('nope.html'),
+                         [os.path.join(d, 'nope.html') for d in (self.first, self.second)])
+        self.assertEqual(self.loader.find('../../etc/passwd'), [])
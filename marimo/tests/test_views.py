@@ -1,13 +1,24 @@
+import copy
 import json
+import threading
+import time
 
+from django.core.exceptions import ImproperlyConfigured
 from django.http import Http404, HttpRequest
-from unittest2 import TestCase
+from unittest2 import TestCase, skipIf
 
 import mock
 
-from marimo.template_loader import TemplateNotFound
-from marimo.views import MarimoRouter
+from marimo.executor import WorkerPool
+from marimo.local_cache import LocalCache
+from marimo.renderer import pystache
+from marimo.template_loader import TemplateNotFound, template_hash
+from marimo.utils import smart_import
+from marimo.views import MarimoRouter, load_registry
+from marimo.views.router import get_registry, load_handler
 from marimo.views import BaseWidget, RequestWidgetHandler
+from marimo.views.base import (SOFT_EXPIRY, LOCK_PREFIX, MARIMO_TIMEOUT, TEMPLATE_PREFIX,
+                               lock_stats)
 
 class FailingWidget(object):
     def __call__(self, request, *args, **kwargs):
@@ -17,15 +28,60 @@ class FailingWidget(object):
         return {'status':'failed'}
 
 
+class CachedWidget(BaseWidget):
+    template = 'cached'
+
+    def cache_key(self, *args, **kwargs):
+        return 'cached:%s' % args[0]
+
+    def cacheable(self, response, *args, **kwargs):
+        response['context']['name'] = args[0]
+        return response
+
+    def uncacheable(self, request, response, *args, **kwargs):
+        response['context']['action'] = args[1]
+        return response
+
+
+class CalledWidget(CachedWidget):
+    def __call__(self, request, *args, **kwargs):
+        return {'status': 'succeeded', 'called': True}
+
+
+class CustomCacheWidget(CachedWidget):
+    def get_cache(self, *args, **kwargs):
+        response = super(CustomCacheWidget, self).get_cache(*args, **kwargs)
+        response['context']['name'] = 'custom'
+        return response
+
+
+class SlowWidget(BaseWidget):
+    def uncacheable(self, request, response, *args, **kwargs):
+        time.sleep(args[0])
+        response['slept'] = args[0]
+        return response
+
+
+class CountedWidget(BaseWidget):
+    instances = 0
+
+    def __init__(self):
+        time.sleep(0.01)
+        CountedWidget.instances += 1
+
+
 widgets = {
         'test': lambda x,y,z: {'key':'value'},
-        'failure': FailingWidget()
+        'failure': FailingWidget(),
+        'cached': CachedWidget(),
+        'slow': SlowWidget(),
 }
 
 
 class TestRouterView(TestCase):
     def setUp(self):
         self.request = mock.Mock()
+        self.request.META = {}
         self.router = MarimoRouter()
 
     def tearDown(self):
@@ -35,7 +91,7 @@ class TestRouterView(TestCase):
         self.assertRaises(Http404, self.router.get, HttpRequest())
 
     @mock.patch('marimo.views.router._marimo_widgets', widgets)
-    @mock.patch('marimo.views.router.HttpResponse')
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
     def test_route_success(self, http_response):
         bulk = [
                 {'id':'1', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}}
@@ -47,7 +103,7 @@ class TestRouterView(TestCase):
         self.assertEqual(response[0]['id'], '1')
 
     @mock.patch('marimo.views.router._marimo_widgets', widgets)
-    @mock.patch('marimo.views.router.HttpResponse')
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
     def test_route_callable_fails(self, http_response):
         bulk = [
                 {'id':'1', 'widget_name':'failure', 'args':['one', 'two'], 'kwargs':{}}
@@ -57,7 +113,7 @@ class TestRouterView(TestCase):
         self.assertEquals(response[0]['status'], 'failed')
 
     @mock.patch('marimo.views.router._marimo_widgets', widgets)
-    @mock.patch('marimo.views.router.HttpResponse')
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
     def test_route_no_such_widget(self, http_response):
         bulk = [
                 {'id':'1', 'widget_name':'nopechucktesta', 'args':['one', 'two'], 'kwargs':{}}
@@ -66,9 +122,529 @@ class TestRouterView(TestCase):
         response = json.loads(http_response.call_args[0][0])
         self.assertEquals(response[0]['status'], 'WidgetNotFound')
 
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    @mock.patch('marimo.views.base.cache')
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
+    def test_route_batches_cache(self, http_response, mock_cache):
+        # every key is read with one get_many and the misses are written
+        # back with one set_many; hits never run cacheable()
+        hit = {'context': {'name': 'hit'}, 'template': 'cached'}
+        mock_cache.get_many.return_value = {'cached:hit': hit}
+        written = {}
+        mock_cache.set_many.side_effect = lambda data, timeout, version: written.update(copy.deepcopy(data))
+        bulk = [
+                {'id':'1', 'widget_name':'cached', 'args':['hit', 'a'], 'kwargs':{}},
+                {'id':'2', 'widget_name':'cached', 'args':['miss', 'b'], 'kwargs':{}},
+                {'id':'3', 'widget_name':'cached', 'args':['miss', 'c'], 'kwargs':{}},
+        ]
+        self.router.route(self.request, bulk)
+        self.assertEqual(mock_cache.get_many.call_count, 1)
+        self.assertEqual(sorted(mock_cache.get_many.call_args[0][0]),
+                         ['cached:hit', 'cached:miss'])
+        self.assertEqual(mock_cache.set_many.call_count, 1)
+        # the entry's template is written along with it
+        thash = written['cached:miss']['response']['template_hash']
+        self.assertEqual(sorted(written), ['cached:miss', TEMPLATE_PREFIX + thash])
+        # the uncacheable part must not end up in the cache
+        self.assertEqual(written['cached:miss']['response']['context'], {'name': 'miss'})
+
+        response = json.loads(http_response.call_args[0][0])
+        self.assertEqual([r['id'] for r in response], ['1', '2', '3'])
+        self.assertEqual([r['context']['action'] for r in response], ['a', 'b', 'c'])
+        self.assertEqual(response[0]['context']['name'], 'hit')
+        self.assertEqual(response[2]['context']['name'], 'miss')
+
+    @mock.patch('marimo.views.base.cache')
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
+    def test_route_contended_share_one_wait(self, http_response, mock_cache):
+        # three handlers whose leases are all held elsewhere wait once,
+        # not once per handler, and then regenerate
+        contended = {}
+        for version in (1, 2, 3):
+            view = CachedWidget()
+            view.cache_version = version
+            view.cache_lock_wait = 0.2
+            view.cache_lock_poll = 0.01
+            contended['cached%d' % version] = view
+        mock_cache.add.return_value = False
+        mock_cache.get_many.return_value = {}
+        bulk = [{'id':str(version), 'widget_name':'cached%d' % version,
+                 'args':['k', 'a'], 'kwargs':{}} for version in (1, 2, 3)]
+        start = time.time()
+        with mock.patch('marimo.views.router._marimo_widgets', contended):
+            self.router.route(self.request, bulk)
+        self.assertTrue(time.time() - start < 0.4)
+        versions = set(call[1]['version'] for call in mock_cache.get_many.call_args_list)
+        self.assertEqual(versions, set([1, 2, 3]))
+        response = json.loads(http_response.call_args[0][0])
+        self.assertEqual([r['context']['name'] for r in response], ['k', 'k', 'k'])
+
+    @mock.patch('marimo.views.base.cache')
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
+    def test_route_honours_overrides(self, http_response, mock_cache):
+        # handlers that override __call__ or get_cache are called as before
+        mock_cache.get_many.return_value = {}
+        mock_cache.get.return_value = None
+        registry = {'called': CalledWidget(), 'custom_cache': CustomCacheWidget(),
+                    'cached': CachedWidget()}
+        bulk = [
+                {'id':'1', 'widget_name':'called', 'args':['k', 'a'], 'kwargs':{}},
+                {'id':'2', 'widget_name':'custom_cache', 'args':['k', 'b'], 'kwargs':{}},
+                {'id':'3', 'widget_name':'cached', 'args':['k', 'c'], 'kwargs':{}},
+        ]
+        with mock.patch('marimo.views.router._marimo_widgets', registry):
+            self.router.route(self.request, bulk)
+        response = json.loads(http_response.call_args[0][0])
+        self.assertEqual(response[0]['called'], True)
+        self.assertEqual(response[1]['context']['name'], 'custom')
+        self.assertEqual(response[2]['context']['name'], 'k')
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    @mock.patch('marimo.views.base.cache')
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
+    def test_route_shared_hit_not_leaked(self, http_response, mock_cache):
+        # different specs, same cache key: both get the one get_many value
+        hit = {'context': {'name': 'hit'}, 'template': 'cached'}
+        mock_cache.get_many.return_value = {'cached:hit': hit}
+        bulk = [
+                {'id':'1', 'widget_name':'cached', 'args':['hit', 'a'], 'kwargs':{}},
+                {'id':'2', 'widget_name':'cached', 'args':['hit', 'b'], 'kwargs':{}},
+        ]
+        self.router.route(self.request, bulk)
+        response = json.loads(http_response.call_args[0][0])
+        self.assertEqual([r['context']['action'] for r in response], ['a', 'b'])
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
+    def test_route_threaded_keeps_order(self, http_response):
+        self.router.threads = 4
+        bulk = [
+                {'id':'1', 'widget_name':'slow', 'args':[0.05], 'kwargs':{}},
+                {'id':'2', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+                {'id':'3', 'widget_name':'nope', 'args':[], 'kwargs':{}},
+        ]
+        self.router.route(self.request, bulk)
+        response = json.loads(http_response.call_args[0][0])
+        self.assertEqual([r['id'] for r in response], ['1', '2', '3'])
+        self.assertEqual([r['status'] for r in response],
+                         ['succeeded', 'succeeded', 'WidgetNotFound'])
+        self.assertEqual(response[0]['slept'], 0.05)
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
+    def test_route_threaded_timeout(self, http_response):
+        self.router.threads = 4
+        self.router.widget_timeout = 0.05
+        bulk = [
+                {'id':'1', 'widget_name':'slow', 'args':[0.5], 'kwargs':{}},
+                {'id':'2', 'widget_name':'slow', 'args':[0], 'kwargs':{}},
+        ]
+        start = time.time()
+        self.router.route(self.request, bulk)
+        self.assertTrue(time.time() - start < 0.4)
+        response = json.loads(http_response.call_args[0][0])
+        self.assertEqual(response[0], {'id': '1', 'status': 'timeout'})
+        self.assertEqual(response[1]['status'], 'succeeded')
+
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
+    def test_route_threaded_skips_abandoned(self, http_response):
+        # widgets no worker started before the bulk timed out never run
+        calls = []
+        def slow(request, *args, **kwargs):
+            calls.append(1)
+            time.sleep(0.1)
+            return {'status': 'succeeded'}
+        self.router.threads = 1
+        self.router.bulk_timeout = 0.03
+        pool = WorkerPool(1)
+        bulk = [{'id':str(i), 'widget_name':'slow', 'args':[i], 'kwargs':{}} for i in range(4)]
+        with mock.patch('marimo.views.router._marimo_widgets', {'slow': slow}):
+            with mock.patch('marimo.views.router.get_pool', return_value=pool):
+                self.router.route(self.request, bulk)
+        response = json.loads(http_response.call_args[0][0])
+        self.assertEqual([r['status'] for r in response], ['timeout'] * 4)
+        pool.submit(lambda: None).wait(1)
+        self.assertEqual(len(calls), 1)
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
+    def test_route_threaded_queue_full(self, http_response):
+        self.router.threads = 4
+        pool = mock.Mock()
+        pool.try_submit.return_value = None
+        bulk = [{'id':'1', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}}]
+        with mock.patch('marimo.views.router.get_pool', return_value=pool) as get_pool:
+            self.router.route(self.request, bulk)
+        self.assertEqual(get_pool.call_args[0], ('router', 4, MarimoRouter.thread_queue))
+        response = json.loads(http_response.call_args[0][0])
+        self.assertEqual(response, [{'id': '1', 'status': 'timeout'}])
+
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
+    def test_route_runs_identical_widgets_once(self, http_response):
+        view = mock.Mock(return_value={'key': 'value'})
+        bulk = [
+                {'id':'1', 'widget_name':'counted', 'args':['a'], 'kwargs':{'k': 1}},
+                {'id':'2', 'widget_name':'counted', 'args':['a'], 'kwargs':{'k': 1}},
+                {'id':'3', 'widget_name':'counted', 'args':['b'], 'kwargs':{'k': 1}},
+        ]
+        with mock.patch('marimo.views.router._marimo_widgets', {'counted': view}):
+            self.router.route(self.request, bulk)
+        self.assertEqual(view.call_count, 2)
+        self.assertEqual(self.router.saved_calls, 1)
+        http_response.return_value.__setitem__.assert_called_with('X-Marimo-Saved-Calls', '1')
+        response = json.loads(http_response.call_args[0][0])
+        self.assertEqual([r['id'] for r in response], ['1', '2', '3'])
+        self.assertEqual(response[1]['key'], 'value')
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    @mock.patch('marimo.views.router.StreamingHttpResponse')
+    def test_route_streaming(self, streaming_response):
+        self.request.REQUEST = {'format': 'ndjson'}
+        self.router.threads = 4
+        bulk = [
+                {'id':'1', 'widget_name':'slow', 'args':[0.2], 'kwargs':{}},
+                {'id':'2', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+                {'id':'3', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+        ]
+        self.router.route(self.request, bulk)
+        self.assertEqual(streaming_response.call_args[1]['content_type'],
+                         'application/x-ndjson')
+        records = [json.loads(line) for line in streaming_response.call_args[0][0]]
+        # the fast widget (and its duplicate) come out before the slow one
+        self.assertEqual([r.get('id') for r in records], ['2', '3', '1', None])
+        self.assertEqual(records[2]['slept'], 0.2)
+        self.assertEqual(records[-1]['__trailer'],
+                         {'widgets': 3, 'saved_calls': 1, 'cache_control': None})
+
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
+    def test_route_groups_cache_calls_by_alias(self, http_response):
+        big = CachedWidget()
+        big.cache_alias = 'big'
+        big.cache_version = 3
+        big.cache_timeout = 1000
+        backends = {'default': mock.Mock(), 'big': mock.Mock()}
+        for backend in backends.values():
+            backend.get_many.return_value = {}
+        bulk = [
+                {'id':'1', 'widget_name':'cached', 'args':['a', 'x'], 'kwargs':{}},
+                {'id':'2', 'widget_name':'big', 'args':['a', 'x'], 'kwargs':{}},
+        ]
+        with mock.patch('marimo.views.router._marimo_widgets', {'cached': CachedWidget(), 'big': big}):
+            with mock.patch('marimo.views.router.cache_for_alias', backends.get):
+                with mock.patch('marimo.views.base.cache_for_alias', backends.get):
+                    self.router.route(self.request, bulk)
+        backends['default'].get_many.assert_called_with(['cached:a'], version=None)
+        backends['big'].get_many.assert_called_with(['cached:a'], version=3)
+        self.assertEqual(backends['big'].set_many.call_args[0][1], 1000)
+        self.assertEqual(backends['big'].set_many.call_args[1], {'version': 3})
+        self.assertEqual(backends['default'].set_many.call_args[0][1], MARIMO_TIMEOUT)
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    @mock.patch('marimo.views.base.cache')
+    def test_route_etag_and_max_age(self, mock_cache):
+        mock_cache.get_many.return_value = {}
+        bulk = [
+                {'id':'1', 'widget_name':'cached', 'args':['a', 'x'], 'kwargs':{}},
+        ]
+        first = self.router.route(self.request, copy.deepcopy(bulk))
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first['Cache-Control'], 'private, max-age=%d' % MARIMO_TIMEOUT)
+        self.assertTrue(first['ETag'])
+
+        self.request.META['HTTP_IF_NONE_MATCH'] = first['ETag']
+        second = self.router.route(self.request, copy.deepcopy(bulk))
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second.content, '')
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    @mock.patch('marimo.views.base.cache')
+    def test_route_max_age_remaining(self, mock_cache):
+        # an entry stored an hour ago has an hour less to live
+        mock_cache.get_many.return_value = {'cached:a': {
+            '__marimo_stored_at': time.time() - 3600,
+            'response': {'context': {}, 'template': 'cached'}}}
+        bulk = [
+                {'id':'1', 'widget_name':'cached', 'args':['a', 'x'], 'kwargs':{}},
+        ]
+        response = self.router.route(self.request, copy.deepcopy(bulk))
+        max_age = int(response['Cache-Control'].split('max-age=')[1])
+        self.assertTrue(MARIMO_TIMEOUT - 3601 <= max_age <= MARIMO_TIMEOUT - 3600)
+        self.assertTrue(response['Cache-Control'].startswith('private'))
+
+        # entries without a store time don't get a max-age
+        mock_cache.get_many.return_value = {'cached:a': {'context': {}, 'template': 'cached'}}
+        response = self.router.route(self.request, copy.deepcopy(bulk))
+        self.assertFalse(response.has_header('Cache-Control'))
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    @mock.patch('marimo.views.base.cache')
+    def test_route_no_max_age_for_mixed(self, mock_cache):
+        mock_cache.get_many.return_value = {}
+        bulk = [
+                {'id':'1', 'widget_name':'cached', 'args':['a', 'x'], 'kwargs':{}},
+                {'id':'2', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+        ]
+        response = self.router.route(self.request, bulk)
+        self.assertFalse(response.has_header('Cache-Control'))
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    def test_route_no_max_age_for_uncached(self):
+        bulk = [
+                {'id':'1', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+        ]
+        response = self.router.route(self.request, bulk)
+        self.assertFalse(response.has_header('Cache-Control'))
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    @mock.patch('marimo.views.router.HttpResponse', new_callable=mock.MagicMock)
+    def test_route_template_refs(self, http_response):
+        self.request.REQUEST = {'template_refs': '1'}
+        bulk = [
+                {'id':'1', 'widget_name':'cached', 'args':['a', 'x'], 'kwargs':{}},
+                {'id':'2', 'widget_name':'cached', 'args':['b', 'x'], 'kwargs':{}},
+        ]
+        self.router.route(self.request, copy.deepcopy(bulk))
+        response = json.loads(http_response.call_args[0][0])
+        thash = template_hash('cached')
+        self.assertEqual(response['templates'], {thash: 'cached'})
+        self.assertEqual([w['template_hash'] for w in response['widgets']], [thash, thash])
+        self.assertFalse('template' in response['widgets'][0])
+
+        self.request.REQUEST['known_templates'] = thash
+        self.router.route(self.request, copy.deepcopy(bulk))
+        response = json.loads(http_response.call_args[0][0])
+        self.assertEqual(response['templates'], {})
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    def test_route_msgpack(self):
+        binary = mock.Mock(content_type='application/msgpack')
+        binary.dumps.return_value = '\x91\x81'
+        bulk = [
+                {'id':'1', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+        ]
+        with mock.patch('marimo.serializers.msgpack_serializer', binary):
+            response = self.router.route(self.request, copy.deepcopy(bulk))
+            # json stays the default
+            self.assertEqual(response['Content-Type'], 'application/json')
+            self.assertEqual(response['Vary'], 'Accept')
+
+            self.request.META['HTTP_ACCEPT'] = 'application/json, application/msgpack;q=0.9'
+            response = self.router.route(self.request, copy.deepcopy(bulk))
+            self.assertEqual(response['Content-Type'], 'application/msgpack')
+            self.assertEqual(response.content, '\x91\x81')
+            self.assertEqual(binary.dumps.call_args[0][0][0]['key'], 'value')
+
+            self.request.META['HTTP_ACCEPT'] = 'application/msgpack;q=0'
+            response = self.router.route(self.request, copy.deepcopy(bulk))
+            self.assertEqual(response['Content-Type'], 'application/json')
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    def test_route_msgpack_not_installed(self):
+        self.request.META['HTTP_ACCEPT'] = 'application/msgpack'
+        bulk = [
+                {'id':'1', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+        ]
+        with mock.patch('marimo.serializers.msgpack_serializer', None):
+            response = self.router.route(self.request, bulk)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertFalse(response.has_header('Vary'))
+
+    @mock.patch('marimo.metrics.hook')
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    @mock.patch('marimo.views.base.cache')
+    def test_route_metrics(self, mock_cache, hook):
+        mock_cache.get_many.return_value = {'cached:hit': {'context': {}, 'template': 'cached'}}
+        bulk = [
+                {'id':'1', 'widget_name':'cached', 'args':['hit', 'a'], 'kwargs':{}},
+                {'id':'2', 'widget_name':'cached', 'args':['miss', 'b'], 'kwargs':{}},
+                {'id':'3', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+        ]
+        with mock.patch.object(MarimoRouter, 'send_server_timing', True):
+            response = self.router.route(self.request, bulk)
+        events = [c[0][1:3] for c in hook.cache_event.call_args_list]
+        self.assertEqual(events, [('hit', 'cached:hit'), ('miss', 'cached:miss'),
+                                  ('regenerate', 'cached:miss')])
+        timings = dict((c[0][1], c[0]) for c in hook.widget_timing.call_args_list)
+        self.assertEqual(sorted(timings), ['1', '2', '3'])
+        self.assertEqual(timings['1'][2], 'hit')
+        self.assertEqual(timings['1'][3]['cacheable'], None)
+        self.assertEqual(timings['2'][2], 'miss')
+        self.assertTrue(timings['2'][3]['cacheable'] is not None)
+        self.assertEqual(timings['3'][2], None)
+        self.assertTrue(timings['3'][3]['uncacheable'] is not None)
+
+        header = response['Server-Timing']
+        self.assertTrue(header.startswith('marimo-cacheable;dur='))
+        self.assertTrue('marimo-cache;desc="hit=1 miss=1"' in header)
+        self.assertTrue('marimo-slowest;dur=' in header)
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    def test_route_server_timing_ids(self):
+        # ids are client supplied and must not break the header
+        for widget_id, desc in ((u'caf\xe9', ';desc=caf'), ('a\nb"c', ';desc=abc'), (u'\xe9', '')):
+            bulk = [{'id':widget_id, 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}}]
+            with mock.patch.object(MarimoRouter, 'send_server_timing', True):
+                response = self.router.route(self.request, bulk)
+            slowest = response['Server-Timing'].split(', ')[-1]
+            self.assertTrue(slowest.startswith('marimo-slowest;dur='))
+            self.assertTrue(slowest.endswith(desc) and slowest.count(';') == desc.count(';') + 1)
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    def test_route_no_server_timing(self):
+        bulk = [
+                {'id':'1', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+        ]
+        response = self.router.route(self.request, bulk)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    def test_prefetch(self):
+        bulk = [
+                {'id':'1', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+                {'id':'2', 'widget_name':'failure', 'args':['one', 'two'], 'kwargs':{}},
+                {'id':'3', 'widget_name':'nopechucktesta', 'args':[], 'kwargs':{}},
+        ]
+        results, nocache = self.router.prefetch(self.request, bulk, 1)
+        # only widgets that succeeded are inlined
+        self.assertEqual(results.keys(), ['1'])
+        self.assertEqual(results['1']['key'], 'value')
+        self.assertEqual(nocache, None)
+
+    def test_prefetch_selected_only(self):
+        inline = SlowWidget()
+        inline.inline = True
+        bulk = [
+                {'id':'1', 'widget_name':'slow', 'args':[0], 'kwargs':{}},
+                {'id':'2', 'widget_name':'inline', 'args':[0], 'kwargs':{}},
+        ]
+        with mock.patch('marimo.views.router._marimo_widgets', {'slow': SlowWidget(), 'inline': inline}):
+            results, nocache = self.router.prefetch(self.request, bulk, 1, selected_only=True)
+        self.assertEqual(results.keys(), ['2'])
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    def test_prefetch_budget(self):
+        bulk = [
+                {'id':'1', 'widget_name':'slow', 'args':[0.3], 'kwargs':{}},
+                {'id':'2', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+        ]
+        start = time.time()
+        results, nocache = self.router.prefetch(self.request, bulk, 0.05)
+        # the slow widget neither holds up the page nor gets inlined
+        self.assertTrue(time.time() - start < 0.2)
+        self.assertEqual(results.keys(), ['2'])
+        self.assertEqual(self.router.bulk_timeout, MarimoRouter.bulk_timeout)
+
+    def test_prefetch_skip_nocache(self):
+        private = lambda request, *args, **kwargs: {'status': 'succeeded',
+                                                    '__nocache_override': 'no-cache'}
+        registry = {'private': private, 'test': widgets['test']}
+        bulk = [
+                {'id':'1', 'widget_name':'private', 'args':[], 'kwargs':{}},
+                {'id':'2', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+        ]
+        with mock.patch('marimo.views.router._marimo_widgets', registry):
+            results, nocache = self.router.prefetch(self.request, bulk, 1)
+            self.assertEqual((sorted(results), nocache), (['1', '2'], 'no-cache'))
+            results, nocache = self.router.prefetch(self.request, bulk, 1, skip_nocache=True)
+            self.assertEqual((sorted(results), nocache), (['2'], None))
+
+    def test_prefetch_cancels_abandoned(self):
+        # widgets nobody waits for any more aren't run at all
+        calls = []
+        def slow(request, *args, **kwargs):
+            calls.append(1)
+            time.sleep(0.1)
+            return {'status': 'succeeded'}
+        pool = WorkerPool(1)
+        bulk = [{'id':str(i), 'widget_name':'slow', 'args':[i], 'kwargs':{}} for i in range(5)]
+        with mock.patch('marimo.views.router._marimo_widgets', {'slow': slow}):
+            with mock.patch('marimo.views.router.get_pool', return_value=pool) as get_pool:
+                results, nocache = self.router.prefetch(self.request, bulk, 0.02)
+        self.assertEqual(results, {})
+        self.assertEqual(get_pool.call_args[0],
+                         ('inline', MarimoRouter.inline_threads, MarimoRouter.inline_queue))
+        done = pool.submit(lambda: None)
+        done.wait(1)
+        self.assertEqual(len(calls), 1)
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    def test_prefetch_queue_full(self):
+        pool = mock.Mock()
+        pool.try_submit.return_value = None
+        bulk = [{'id':'1', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}}]
+        with mock.patch('marimo.views.router.get_pool', return_value=pool):
+            results, nocache = self.router.prefetch(self.request, bulk, 0.05)
+        # left to the client
+        self.assertEqual(results, {})
+
+    @mock.patch('marimo.views.router._marimo_widgets', widgets)
+    @mock.patch('marimo.views.base.cache')
+    def test_warm(self, mock_cache):
+        mock_cache.get_many.return_value = {'cached:hit': {'context': {}, 'template': 'cached'}}
+        bulk = [
+                {'id':'1', 'widget_name':'cached', 'args':['hit', 'a'], 'kwargs':{}},
+                {'id':'2', 'widget_name':'cached', 'args':['miss', 'b'], 'kwargs':{}},
+                {'id':'3', 'widget_name':'test', 'args':['one', 'two'], 'kwargs':{}},
+        ]
+        with mock.patch.object(CachedWidget, 'uncacheable') as uncacheable:
+            self.router.warm(self.request, bulk)
+        self.assertFalse(uncacheable.called)
+        self.assertEqual(mock_cache.set_many.call_count, 1)
+        written = mock_cache.set_many.call_args[0][0]
+        self.assertEqual([key for key in written if not key.startswith(TEMPLATE_PREFIX)],
+                         ['cached:miss'])
+
+    @mock.patch('marimo.views.base.cache')
+    def test_warm_skips_keyless(self, mock_cache):
+        keyless = CachedWidget()
+        keyless.cache_key = lambda *args, **kwargs: None
+        keyless.cacheable = mock.Mock()
+        bulk = [{'id':'1', 'widget_name':'keyless', 'args':['a', 'b'], 'kwargs':{}}]
+        with mock.patch('marimo.views.router._marimo_widgets', {'keyless': keyless}):
+            self.router.warm(self.request, bulk)
+        self.assertFalse(keyless.cacheable.called)
+        self.assertFalse(mock_cache.set_many.called)
+
     # TODO test fetching a callable with smart_import. this is too gnarly for now.
 
 
+class TestRegistry(TestCase):
+    def setUp(self):
+        # the registry imports by path, which may not be this module object
+        self.counted = smart_import('marimo.tests.test_views.CountedWidget')
+        self.counted.instances = 0
+
+    def test_load_registry(self):
+        registry = {'counted': 'marimo.tests.test_views.CountedWidget', 'test': widgets['test']}
+        with mock.patch('marimo.views.router._marimo_widgets', registry):
+            timings = load_registry()
+        self.assertEqual(sorted(timings), ['counted', 'test'])
+        self.assertTrue(isinstance(registry['counted'], self.counted))
+
+    def test_load_registry_bad_path(self):
+        with mock.patch('marimo.views.router._marimo_widgets', {'bad': 'marimo.tests.nope.Widget'}):
+            self.assertRaises(ImproperlyConfigured, load_registry)
+
+    def test_get_registry(self):
+        self.assertEqual(get_registry(None), {})
+        self.assertEqual(sorted(get_registry('marimo.tests.test_views.widgets')), sorted(widgets))
+        # a typo must not pass for an empty registry
+        self.assertRaises(ImproperlyConfigured, get_registry, 'marimo.tests.test_views.widgetz')
+        self.assertRaises(ImproperlyConfigured, get_registry, 'marimo.nosuchmodule.widgets')
+
+    def test_load_handler_once(self):
+        registry = {'counted': 'marimo.tests.test_views.CountedWidget'}
+        with mock.patch('marimo.views.router._marimo_widgets', registry):
+            threads = [threading.Thread(target=load_handler, args=('counted',))
+                       for i in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(self.counted.instances, 1)
+
+
 class TestBaseView(TestCase):
     def setUp(self):
         self.base = BaseWidget()
@@ -93,7 +669,7 @@ class TestBaseView(TestCase):
         self.base.cache_key = lambda *a, **kw: 'key'
         mock_cache.get.return_value = None
         self.base('request', 'arg', kwarg='kwval')
-        self.assertTrue(mock_cache.set.called)
+        self.assertTrue(mock_cache.set_many.called)
         self.assertTrue(self.base.cacheable.called)
         self.assertTrue(self.base.uncacheable.called)
 
@@ -107,6 +683,131 @@ class TestBaseView(TestCase):
         self.assertFalse(self.base.cacheable.called)
         self.assertTrue(self.base.uncacheable.called)
 
+    @mock.patch('marimo.metrics.hook')
+    @mock.patch('marimo.views.base.cache')
+    def test_base_metrics(self, mock_cache, hook):
+        self.base.cache_key = lambda *a, **kw: 'key'
+        mock_cache.get.return_value = None
+        self.base('request', 'arg')
+        events = [c[0][1] for c in hook.cache_event.call_args_list]
+        self.assertEqual(events, ['miss', 'regenerate'])
+        self.assertTrue(hook.cache_event.call_args[0][3] >= 0)
+        name, widget_id, cache, timings = hook.widget_timing.call_args[0]
+        self.assertEqual(name, 'RequestWidgetHandler')
+        self.assertEqual(sorted(timings), ['cacheable', 'total', 'uncacheable'])
+
+        mock_cache.get.return_value = {'context': {}}
+        self.base('request', 'arg')
+        self.assertEqual(hook.cache_event.call_args[0][1], 'hit')
+
+    @mock.patch('marimo.views.base.cache')
+    def test_base_cache_stale_served_and_refreshed(self, mock_cache):
+        # past the soft expiry the stale value is served and one background
+        # regeneration is scheduled
+        self.base.cacheable = mock.Mock(return_value={'fresh': True})
+        self.base.cache_key = lambda *a, **kw: 'key'
+        self.base.cache_soft_timeout = 10
+        mock_cache.get.return_value = {SOFT_EXPIRY: time.time() - 1,
+                                       'response': {'fresh': False}}
+        with mock.patch.object(self.base, 'schedule_refresh') as refresh:
+            self.base('request', 'arg')
+        refresh.assert_called_with('key', 'arg')
+        self.assertFalse(self.base.cacheable.called)
+        self.assertEqual(self.base.uncacheable.call_args[0][1], {'fresh': False})
+
+    @mock.patch('marimo.views.base.cache')
+    def test_base_cache_refresh_runs_once(self, mock_cache):
+        self.base.cache_soft_timeout = 10
+        self.base.build_cache = mock.Mock(return_value={'fresh': True})
+        pool = mock.Mock()
+        pool.try_submit.side_effect = lambda fn, *a: fn(*a) or True
+        with mock.patch('marimo.views.base.get_pool', return_value=pool):
+            with mock.patch('marimo.views.base._refreshing', set(['key'])):
+                self.assertFalse(self.base.schedule_refresh('key', 'arg'))
+            self.assertTrue(self.base.schedule_refresh('key', 'arg'))
+        self.assertEqual(pool.try_submit.call_count, 1)
+        stored = mock_cache.set_many.call_args[0][0]['key']
+        self.assertEqual(stored['response'], {'fresh': True})
+        self.assertTrue(stored[SOFT_EXPIRY] > time.time())
+
+    @mock.patch('marimo.views.base.cache')
+    def test_base_cache_miss_waits_for_lease_holder(self, mock_cache):
+        # somebody else holds the regeneration lease; wait for their value
+        # instead of running cacheable() as well
+        self.base.cacheable = mock.Mock()
+        self.base.cache_key = lambda *a, **kw: 'key'
+        self.base.cache_lock_poll = 0
+        mock_cache.get.return_value = None
+        mock_cache.add.return_value = False
+        mock_cache.get_many.side_effect = [{}, {'key': {'from': 'holder'}}]
+        before = lock_stats()
+        self.base('request', 'arg')
+        self.assertFalse(self.base.cacheable.called)
+        self.assertEqual(self.base.uncacheable.call_args[0][1], {'from': 'holder'})
+        after = lock_stats()
+        self.assertEqual(after['contended'], before['contended'] + 1)
+        self.assertEqual(after['waited'], before['waited'] + 1)
+
+    @mock.patch('marimo.views.base.cache')
+    def test_base_cache_miss_takes_lease(self, mock_cache):
+        self.base.cacheable = mock.Mock(return_value={'fresh': True})
+        self.base.cache_key = lambda *a, **kw: 'key'
+        mock_cache.get.return_value = None
+        mock_cache.add.return_value = True
+        self.base('request', 'arg')
+        self.assertEqual(mock_cache.add.call_args[0][0], LOCK_PREFIX + 'key')
+        stored = mock_cache.set_many.call_args
+        self.assertEqual(stored[0][0].keys(), ['key'])
+        self.assertEqual(stored[0][0]['key']['response'], {'fresh': True})
+        self.assertEqual(stored[0][1], self.base.cache_timeout)
+        self.assertEqual(stored[1], {'version': None})
+        mock_cache.delete.assert_called_with(LOCK_PREFIX + 'key', version=None)
+
+    @mock.patch('marimo.views.base.cache')
+    def test_base_local_cache(self, mock_cache):
+        # with local_cache_timeout the second read skips the django cache,
+        # and update_cache drops the local copy
+        self.base.cache_key = lambda *a, **kw: 'local-key'
+        self.base.local_cache_timeout = 10
+        mock_cache.get.return_value = {'context': {'n': 1}}
+        with mock.patch('marimo.views.base.local_cache', LocalCache()) as local:
+            self.assertEqual(self.base.get_cache('arg'), {'context': {'n': 1}})
+            self.assertEqual(self.base.get_cache('arg'), {'context': {'n': 1}})
+            self.assertEqual(mock_cache.get.call_count, 1)
+            self.base.cacheable = lambda response, *a, **kw: {'context': {'n': 2}}
+            self.base.update_cache('arg')
+            self.assertEqual(local.get(self.base.local_key('local-key'))['response'], {'context': {'n': 2}})
+
+    @mock.patch('marimo.views.base.cache')
+    def test_base_cache_stores_template_by_hash(self, mock_cache):
+        self.base.cache_key = lambda *a, **kw: 'key'
+        packed = self.base.pack_cache({'context': {}, 'template': 'some_template'})
+        self.assertEqual(packed['response'], {'context': {}, 'template_hash': template_hash('some_template')})
+        self.assertEqual(self.base.unpack_cache(packed),
+                         ({'context': {}, 'template': 'some_template'}, False))
+        # an entry whose template is gone is a miss
+        mock_cache.get.return_value = None
+        self.assertEqual(self.base.unpack_cache({'context': {}, 'template_hash': 'gone'}),
+                         (None, False))
+
+    @mock.patch('marimo.views.base.cache')
+    @mock.patch('marimo.views.base.template_registry')
+    def test_base_cache_rewrites_template(self, registry, mock_cache):
+        # every stored entry writes its template again, so the shared copy
+        # can't expire or be evicted while entries still refer to it
+        registry.add.side_effect = template_hash
+        registry.get.return_value = None
+        store = {}
+        mock_cache.set_many.side_effect = lambda values, timeout, version: store.update(values)
+        mock_cache.get.side_effect = lambda key, version=None: store.get(key)
+        response = {'context': {}, 'template': 'some_template'}
+        self.base.set_cache('key', response)
+        key = TEMPLATE_PREFIX + template_hash('some_template')
+        del store[key]
+        self.base.set_cache('key', response)
+        self.assertEqual(store[key], 'some_template')
+        self.assertEqual(self.base.unpack_cache(store['key']), (response, False))
+
     def test_nocache_override(self):
         response = dict()
         self.base.nocache_override(response)
@@ -133,6 +834,28 @@ class TestRequestWidgetHandlerView(TestCase):
 
         mtpl.load.assert_called_with(template_path)
 
+    @skipIf(pystache is None, 'pystache is not installed')
+    def test_server_render(self):
+        self.handler.template = 'hello {{ name }}, {{ action }}'
+        self.handler.server_render = True
+        self.handler.cacheable = lambda response, *a, **kw: dict(response, context={'name': '<nate>'})
+        self.handler.uncacheable = mock.Mock(side_effect=lambda request, response, *a, **kw: (
+            response['context'].update(action='hug') or response))
+        response = self.handler('request')
+        self.assertEqual(response, {'html': 'hello &lt;nate&gt;, hug'})
+
+    @skipIf(pystache is None, 'pystache is not installed')
+    def test_server_render_cached(self):
+        self.handler.template = 'hello {{ name }}'
+        self.handler.server_render = True
+        self.handler.cache_rendered = True
+        self.handler.cacheable = lambda response, *a, **kw: dict(response, context={'name': 'nate'})
+        cached = self.handler.build_cache()
+        self.assertEqual(cached, {'html': 'hello nate'})
+        with mock.patch('marimo.views.base.render_template') as render:
+            self.assertEqual(self.handler.finalize('request', cached), {'html': 'hello nate'})
+        self.assertFalse(render.called)
+
     def test_base_default_response_no_template(self):
         with mock.patch('marimo.views.base.template_loader') as mtpl:
             self.handler.default_response()
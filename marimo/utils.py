@@ -1,3 +1,6 @@
+import hashlib
+import json
+
 from django.utils.importlib import import_module
 
 def smart_import(mpath):
@@ -28,3 +31,30 @@ def composition_decorator(decfn):
 
     '''
     return lambda fn: lambda *a, **kw: decfn(fn(*a, **kw))
+
+def widget_id(context, prefix, *spec):
+    """
+    A DOM id for a widget that only depends on what the widget is, so
+    identical pages render identical html.
+
+    The id is prefix + a hash of spec. Repeats of the same spec within a
+    request get a counter appended so ids stay unique. Without the marimo
+    middleware the counter lives in the template Context, so it covers
+    includes but not fragments rendered with a Context of their own.
+    """
+    digest = hashlib.md5(json.dumps(spec, sort_keys=True, default=repr)).hexdigest()[:8]
+    base = '%s%s' % (prefix, digest)
+    seen = context.get('marimo_ids', None)
+    if seen is None:
+        render_context = getattr(context, 'render_context', None)
+        if render_context is None:
+            return base
+        # every template render (includes too) pushes a fresh level; count
+        # on the bottom one, which lasts as long as the Context
+        root = render_context.dicts[0]
+        seen = root.setdefault('marimo_ids', {})
+    count = seen.get(base, 0)
+    seen[base] = count + 1
+    if count:
+        return '%s_%d' % (base, count)
+    return base
@@ -1,2 +1,8 @@
-from marimo.views.router import MarimoRouter
+from django.conf import settings
+
+from marimo.views.router import MarimoRouter, load_registry
 from marimo.views.base import BaseWidgetHandler, RequestWidgetHandler, BaseWidget
+
+# loaded here rather than in router so handlers can import from marimo.views
+if getattr(settings, 'MARIMO_LOAD_REGISTRY', False):
+    load_registry()
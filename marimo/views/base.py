@@ -1,17 +1,95 @@
 """
 BaseWidget is the a base class that can be extended to make marimo widget handlers
 """
-import json
+import logging
 import sys
+import threading
+import time
 import traceback
 
 from django.conf import settings
-from django.core.cache import cache
+from django.core.cache import cache, get_cache as load_cache
+from django.core.cache.backends.dummy import DummyCache
 from django.http import HttpResponse
 
-from marimo.template_loader import template_loader, TemplateNotFound
+from marimo import metrics, serializers
+from marimo.executor import get_pool
+from marimo.local_cache import local_cache
+from marimo.renderer import render_template
+from marimo.template_loader import (template_hash, template_loader, template_registry,
+                                    TemplateNotFound)
+
+logger = logging.getLogger(__name__)
 
 MARIMO_TIMEOUT = getattr(settings, 'MARIMO_TIMEOUT', 60*60*24)
+MARIMO_CACHE_ALIAS = getattr(settings, 'MARIMO_CACHE_ALIAS', 'default')
+MARIMO_SERVER_RENDER = getattr(settings, 'MARIMO_SERVER_RENDER', False)
+MARIMO_REFRESH_THREADS = getattr(settings, 'MARIMO_REFRESH_THREADS', 2)
+MARIMO_REFRESH_QUEUE = getattr(settings, 'MARIMO_REFRESH_QUEUE', 100)
+MARIMO_LOCK_TIMEOUT = getattr(settings, 'MARIMO_LOCK_TIMEOUT', 30)
+MARIMO_LOCK_WAIT = getattr(settings, 'MARIMO_LOCK_WAIT', 1)
+MARIMO_LOCAL_CACHE_TIMEOUT = getattr(settings, 'MARIMO_LOCAL_CACHE_TIMEOUT', None)
+
+# marks a cached value that carries a soft expiry next to the payload
+SOFT_EXPIRY = '__marimo_soft_expiry'
+STORED_AT = '__marimo_stored_at'
+# prefix of the lease keys that let one caller at a time regenerate a key
+LOCK_PREFIX = 'marimo-lock:'
+# prefix of the keys templates are stored under, by content hash
+TEMPLATE_PREFIX = 'marimo-template:'
+
+# how often regeneration leases were taken, found taken by someone else,
+# waited out successfully, or waited for in vain. See lock_stats().
+_lock_counts = {'acquired': 0, 'contended': 0, 'waited': 0, 'wait_timeout': 0}
+_lock_counts_lock = threading.Lock()
+
+
+def count_lock(event):
+    """ bumps one of the regeneration lease counters """
+    _lock_counts_lock.acquire()
+    try:
+        _lock_counts[event] += 1
+    finally:
+        _lock_counts_lock.release()
+
+
+def lock_stats():
+    """ returns a copy of this process' regeneration lease counters """
+    return dict(_lock_counts)
+
+
+# cache backends for aliases other than 'default', loaded on first use
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def cache_for_alias(alias):
+    """ returns the cache backend for an alias in CACHES """
+    if alias == 'default':
+        return cache
+    try:
+        return _backends[alias]
+    except KeyError:
+        _backends_lock.acquire()
+        try:
+            if alias not in _backends:
+                _backends[alias] = load_cache(alias)
+            return _backends[alias]
+        finally:
+            _backends_lock.release()
+
+def set_many(backend, values, timeout, version=None):
+    """
+    backend.set_many(), except for django 1.3's DummyCache whose set_many
+    doesn't take a timeout (and wouldn't store anything anyway).
+    """
+    if isinstance(backend, DummyCache):
+        return
+    backend.set_many(values, timeout, version=version)
+
+# cache keys with a background regeneration in flight in this process
+_refreshing = set()
+_refreshing_lock = threading.Lock()
 
 class BaseWidgetHandler(object):
     """
@@ -27,6 +105,42 @@ class BaseWidgetHandler(object):
     # should be set in the response
     nocache = False
 
+    # set to True to have this widget run while the page is generated and
+    # its response embedded in the page, when MARIMO_INLINE is 'selected'
+    inline = False
+
+    # seconds this widget may run when the router executes widgets on its
+    # thread pool; None falls back to MARIMO_WIDGET_TIMEOUT
+    widget_timeout = None
+
+    # seconds the cacheable part stays in the cache (the hard expiry)
+    cache_timeout = MARIMO_TIMEOUT
+
+    # the alias in CACHES to store the cacheable part in, and the key
+    # version passed to it. Bump cache_version to invalidate every key of a
+    # handler at once.
+    cache_alias = MARIMO_CACHE_ALIAS
+    cache_version = None
+
+    # seconds after which a cached cacheable part is stale (the soft expiry).
+    # Stale values are still served while a background thread regenerates
+    # them; only a value past cache_timeout makes a request wait for
+    # cacheable(). None turns this off.
+    cache_soft_timeout = None
+
+    # Seconds a regeneration lease lasts. While one caller regenerates a
+    # missing key the others wait up to cache_lock_wait seconds for it (or
+    # keep serving the stale value) instead of all running cacheable() at
+    # once. None turns the lease off.
+    cache_lock_timeout = MARIMO_LOCK_TIMEOUT
+    cache_lock_wait = MARIMO_LOCK_WAIT
+    cache_lock_poll = 0.05
+
+    # Seconds to keep the cacheable part in this process' LRU cache in front
+    # of the django cache. Meant to be short and used for small, very hot
+    # widgets. None turns it off.
+    local_cache_timeout = MARIMO_LOCAL_CACHE_TIMEOUT
+
     def default_response(self, *args, **kwargs):
         """A default response to pass into cacheable(), which will be modified
         and eventually returned.
@@ -86,6 +200,14 @@ class BaseWidgetHandler(object):
         """
         pass
 
+    def build_cache(self, *args, **kwargs):
+        """
+        Generates the cacheable part of the response from scratch by passing
+        default_response() through cacheable(). Does not touch the cache.
+        """
+        response = self.default_response(*args, **kwargs)
+        return self.cacheable(response, *args, **kwargs)
+
     def get_cache(self, *args, **kwargs):
         """
         get current cached cacheable part. Updates data in cache with data from
@@ -96,16 +218,207 @@ class BaseWidgetHandler(object):
         response = None
         cache_key = self.cache_key(*args, **kwargs)
         if cache_key and not kwargs.get('__force_update', False):
-            response = cache.get(cache_key)
+            response, stale = self.unpack_cache(self.read_cache(cache_key))
+            if stale:
+                self.cache_event('stale', cache_key)
+                self.schedule_refresh(cache_key, *args, **kwargs)
+            elif response is not None:
+                self.cache_event('hit', cache_key)
+            else:
+                self.cache_event('miss', cache_key)
+        if response is None:
+            if cache_key and not kwargs.get('__force_update', False):
+                response = self.regenerate_cache(cache_key, *args, **kwargs)
+            else:
+                response = self.build_cache(*args, **kwargs)
+                if cache_key:
+                    self.set_cache(cache_key, response)
+        return response
+
+    def regenerate_cache(self, cache_key, *args, **kwargs):
+        """
+        Regenerates a missing cache entry, letting only one caller at a time
+        run cacheable() for cache_key.
+
+        The caller that gets the lease regenerates and stores the entry. The
+        others poll the cache for up to cache_lock_wait seconds and only
+        regenerate it themselves if it doesn't show up in time.
+        """
+        if self.acquire_cache_lock(cache_key):
+            try:
+                response = self.timed_build(cache_key, 'regenerate', *args, **kwargs)
+                self.set_cache(cache_key, response)
+            finally:
+                self.release_cache_lock(cache_key)
+            return response
+
+        response = self.wait_for_cache([cache_key]).get(cache_key)
         if response is None:
-            response = self.default_response(*args, **kwargs)
-            response = self.cacheable(response, *args, **kwargs)
-            if cache_key:
-                cache.set(cache_key, response, MARIMO_TIMEOUT)
+            response = self.timed_build(cache_key, 'regenerate', *args, **kwargs)
+            self.set_cache(cache_key, response)
+        return response
+
+    def timed_build(self, cache_key, event, *args, **kwargs):
+        """ build_cache(), reported to the metrics hook as event """
+        start = time.time()
+        response = self.build_cache(*args, **kwargs)
+        self.cache_event(event, cache_key, time.time() - start)
         return response
 
+    def cache_event(self, event, cache_key, duration=None):
+        """ reports event for cache_key to the metrics hook """
+        metrics.cache_event(self.__class__.__name__, event, cache_key, duration)
+
+    def acquire_cache_lock(self, cache_key):
+        """
+        Tries to take the regeneration lease for cache_key with cache.add().
+        Always succeeds if cache_lock_timeout is None.
+        """
+        if not self.cache_lock_timeout:
+            return True
+        if self.cache_backend().add(LOCK_PREFIX + cache_key, 1, self.cache_lock_timeout,
+                                    version=self.cache_version):
+            count_lock('acquired')
+            return True
+        count_lock('contended')
+        return False
+
+    def release_cache_lock(self, cache_key):
+        if self.cache_lock_timeout:
+            self.cache_backend().delete(LOCK_PREFIX + cache_key, version=self.cache_version)
+
+    def wait_for_cache(self, cache_keys):
+        """
+        Polls the cache for up to cache_lock_wait seconds until every key in
+        cache_keys shows up and returns a dict of the responses found.
+        """
+        found = {}
+        deadline = time.time() + self.cache_lock_wait
+        remaining = list(cache_keys)
+        while remaining and time.time() < deadline:
+            time.sleep(self.cache_lock_poll)
+            values = self.cache_backend().get_many(remaining, version=self.cache_version)
+            for key, value in values.items():
+                found[key] = self.unpack_cache(value)[0]
+            remaining = [key for key in remaining if key not in found]
+        for key in cache_keys:
+            count_lock('waited' if key in found else 'wait_timeout')
+        return found
+
+    def pack_cache(self, response):
+        """
+        Returns the value to store in the cache for a cacheable response: the
+        response wrapped together with when it was stored and, with
+        cache_soft_timeout, its soft expiry.
+        """
+        now = time.time()
+        value = {STORED_AT: now, 'response': response}
+        if self.cache_soft_timeout:
+            value[SOFT_EXPIRY] = now + self.cache_soft_timeout
+        return value
+
+    def unpack_cache(self, value):
+        """
+        The reverse of pack_cache. Returns a (response, stale) tuple; response
+        is None if value is None.
+        """
+        if isinstance(value, dict) and (STORED_AT in value or SOFT_EXPIRY in value):
+            expiry = value.get(SOFT_EXPIRY)
+            return value['response'], expiry is not None and expiry <= time.time()
+        return value, False
+
+    def fresh_for(self, value=None):
+        """
+        Seconds the cached value (as returned by pack_cache) stays fresh, or
+        for a response that was just generated if value is None. None if it
+        isn't known, e.g. for entries written before they carried a time.
+        """
+        lifetime = self.cache_soft_timeout or self.cache_timeout
+        if value is None:
+            return lifetime
+        if not isinstance(value, dict) or STORED_AT not in value or lifetime is None:
+            return None
+        return max(0, value[STORED_AT] + lifetime - time.time())
+
+    def read_cache(self, cache_key):
+        """
+        Returns the raw cached value for cache_key, trying the local cache
+        first if local_cache_timeout is set.
+        """
+        backend = self.cache_backend()
+        if not self.local_cache_timeout:
+            return backend.get(cache_key, version=self.cache_version)
+        value = local_cache.get(self.local_key(cache_key))
+        if value is None:
+            value = backend.get(cache_key, version=self.cache_version)
+            if value is not None:
+                local_cache.set(self.local_key(cache_key), value, self.local_cache_timeout)
+        return value
+
+    def cache_values(self, cache_key, response):
+        """
+        The keys and values to write to the cache to store a cacheable
+        response under cache_key: the packed response, plus whatever else it
+        needs to be read back.
+        """
+        return {cache_key: self.pack_cache(response)}
+
+    def set_cache(self, cache_key, response):
+        """ stores a cacheable response under cache_key """
+        values = self.cache_values(cache_key, response)
+        set_many(self.cache_backend(), values, self.cache_timeout, version=self.cache_version)
+        if self.local_cache_timeout:
+            local_cache.set(self.local_key(cache_key), values[cache_key], self.local_cache_timeout)
+
+    def cache_backend(self):
+        """ the django cache backend for cache_alias """
+        return cache_for_alias(self.cache_alias)
+
+    def local_key(self, cache_key):
+        """
+        The key of cache_key in the local cache, which is shared by every
+        cache alias and version.
+        """
+        return '%s:%s:%s' % (self.cache_alias, self.cache_version, cache_key)
+
+    def schedule_refresh(self, cache_key, *args, **kwargs):
+        """
+        Regenerates a stale cache entry on a background thread. Does nothing
+        if a regeneration of cache_key is already running in this process or
+        the background queue is full. Returns True if one was scheduled.
+        """
+        _refreshing_lock.acquire()
+        try:
+            if cache_key in _refreshing:
+                return False
+            _refreshing.add(cache_key)
+        finally:
+            _refreshing_lock.release()
+
+        pool = get_pool('refresh', MARIMO_REFRESH_THREADS, MARIMO_REFRESH_QUEUE)
+        if pool.try_submit(self._refresh, cache_key, args, kwargs) is None:
+            _refreshing.discard(cache_key)
+            return False
+        return True
+
+    def _refresh(self, cache_key, args, kwargs):
+        try:
+            # someone else holding the lease is already regenerating it
+            if self.acquire_cache_lock(cache_key):
+                try:
+                    self.set_cache(cache_key, self.timed_build(cache_key, 'refresh', *args, **kwargs))
+                finally:
+                    self.release_cache_lock(cache_key)
+        except Exception:
+            logger.exception('background regeneration of %s failed', cache_key)
+        finally:
+            _refreshing.discard(cache_key)
+
     def update_cache(self, *args, **kwargs):
         """ convenience wrapper around get_cache for cache invalidation """
+        cache_key = self.cache_key(*args, **kwargs)
+        if cache_key and self.local_cache_timeout:
+            local_cache.delete(self.local_key(cache_key))
         # we expect the caller to discard the return value but why not return
         # it anyway.
         return self.get_cache(__force_update=True, *args, **kwargs)
@@ -135,22 +448,39 @@ class BaseWidgetHandler(object):
         """
         response['__nocache_override'] = 'no-cache,max-age=0'
 
-    def __call__(self, request, *args, **kwargs):
-        """ Splits up work into cachable and uncacheable parts """
-        response = self.get_cache(*args, **kwargs)
+    def finalize(self, request, response, *args, **kwargs):
+        """
+        Adds the uncacheable part to an already fetched cacheable response.
+        The router uses this after fetching the cacheable parts of a whole
+        bulk request at once.
+        """
         response = self.uncacheable(request, response, *args, **kwargs)
         if self.nocache:
             self.nocache_override(response)
         return response
 
+    def __call__(self, request, *args, **kwargs):
+        """ Splits up work into cachable and uncacheable parts """
+        start = time.time()
+        response = self.get_cache(*args, **kwargs)
+        cached = time.time()
+        response = self.finalize(request, response, *args, **kwargs)
+        end = time.time()
+        metrics.widget_timing(self.__class__.__name__, None, None, {
+            'cacheable': cached - start,
+            'uncacheable': end - cached,
+            'total': end - start,
+        })
+        return response
+
     @classmethod
     def as_view(cls):
         """ as_view can be used to create views for marimo widgets only reccomended for debugging """
         def view(request):
             inst = cls()
-            data = json.loads(request.GET['data'])
+            data = serializers.loads(request.GET['data'])
             response = inst(request, *data['args'], **data['kwargs'])
-            return HttpResponse(json.dumps(response), mimetype='application/json')
+            return HttpResponse(serializers.dumps(response), mimetype='application/json')
         return view
 
 class RequestWidgetHandler(BaseWidgetHandler):
@@ -175,8 +505,15 @@ class RequestWidgetHandler(BaseWidgetHandler):
 
         template = template_loader.load('my_template.html')
 
+    Set ``server_render`` to render the widget on the server (this needs
+    pystache). The response then holds the finished ``html`` instead of a
+    template and context. If uncacheable() never touches the context, also
+    set ``cache_rendered`` so the html is rendered once and cached.
+
     """
     template = ''
+    server_render = MARIMO_SERVER_RENDER
+    cache_rendered = False
 
     def default_response(self, *args, **kwargs):
         """A default response to pass into cacheable(), which will be modified
@@ -200,5 +537,77 @@ class RequestWidgetHandler(BaseWidgetHandler):
         response['template'] = template
         return response
 
+    def build_cache(self, *args, **kwargs):
+        response = super(RequestWidgetHandler, self).build_cache(*args, **kwargs)
+        if self.server_render and self.cache_rendered:
+            response = self.render(response)
+        return response
+
+    def finalize(self, request, response, *args, **kwargs):
+        response = super(RequestWidgetHandler, self).finalize(request, response, *args, **kwargs)
+        if self.server_render and 'html' not in response:
+            response = self.render(response)
+        return response
+
+    def render(self, response):
+        """
+        Returns a copy of response with its template and context replaced by
+        the rendered html.
+        """
+        response = dict(response)
+        template = response.pop('template')
+        response['html'] = render_template(template, response.pop('context'))
+        return response
+
+    def pack_cache(self, response):
+        """
+        Stores the template by content hash instead of in every cache entry;
+        the entry only refers to it as template_hash.
+        """
+        template = isinstance(response, dict) and response.get('template')
+        if template:
+            response = dict(response)
+            del response['template']
+            response['template_hash'] = self.store_template(template)
+        return super(RequestWidgetHandler, self).pack_cache(response)
+
+    def unpack_cache(self, value):
+        """
+        Puts the template referred to by template_hash back in the response.
+        An entry whose template can't be found anymore counts as a miss.
+        """
+        response, stale = super(RequestWidgetHandler, self).unpack_cache(value)
+        if response is not None and 'template_hash' in response:
+            template = self.load_template(response.pop('template_hash'))
+            if template is None:
+                return None, False
+            response['template'] = template
+        return response, stale
+
+    def cache_values(self, cache_key, response):
+        """
+        Writes the template along with every entry that refers to it, with
+        the same timeout, so the shared copy can't expire (or be evicted
+        and never written again) while entries still need it.
+        """
+        values = super(RequestWidgetHandler, self).cache_values(cache_key, response)
+        template = isinstance(response, dict) and response.get('template')
+        if template:
+            values[TEMPLATE_PREFIX + template_hash(template)] = template
+        return values
+
+    def store_template(self, template):
+        """ registers template in this process and returns its content hash """
+        return template_registry.add(template)
+
+    def load_template(self, thash):
+        """ finds a template by content hash, returning None if it's gone """
+        template = template_registry.get(thash)
+        if template is None:
+            template = self.cache_backend().get(TEMPLATE_PREFIX + thash, version=self.cache_version)
+            if template is not None:
+                template_registry.add(template)
+        return template
+
 # backwards compatibility. Once nothing else refers to BaseWidget, delete this
 BaseWidget = RequestWidgetHandler
@@ -1,15 +1,160 @@
+import Queue
+import copy
+import hashlib
 import json
+import logging
+import re
+import threading
+import time
 
 from django.conf import settings
-from django.http import Http404, HttpResponse
+from django.core.exceptions import ImproperlyConfigured
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # django < 1.5 streams any HttpResponse built from an iterator
+    StreamingHttpResponse = HttpResponse
+from django.utils.encoding import smart_str
 from django.views.generic.base import View
 
+from marimo import metrics, serializers
+from marimo.executor import get_pool
+from marimo.local_cache import local_cache
+from marimo.slow_log import slow_log
+from marimo.template_loader import template_hash
 from marimo.utils import smart_import
+from marimo.views.base import (BaseWidgetHandler, LOCK_PREFIX, cache_for_alias, count_lock,
+                               set_many)
 
-try:
-    _marimo_widgets = smart_import(settings.MARIMO_REGISTRY)
-except AttributeError:
-    _marimo_widgets = {}
+logger = logging.getLogger(__name__)
+
+# Accept header values that get a MessagePack bulk response
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+# anything but the characters of an http token, the only ones client
+# supplied widget ids may bring into a header
+NON_TOKEN = re.compile(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]")
+
+
+def get_registry(path=None):
+    """
+    returns the registry at path, or an empty one if path is None. Raises
+    ImproperlyConfigured if path can't be imported.
+    """
+    if path is None:
+        return {}
+    try:
+        return smart_import(path)
+    except (ImportError, AttributeError, ValueError), e:
+        raise ImproperlyConfigured('unknown marimo registry %r: %s' % (path, e))
+
+
+_marimo_widgets = get_registry(getattr(settings, 'MARIMO_REGISTRY', None))
+# held while a registry entry is imported and instantiated, so concurrent
+# first requests for a widget don't create its handler twice
+_registry_lock = threading.Lock()
+
+
+def load_handler(widget_name):
+    """
+    Returns the handler registered for widget_name, importing and
+    instantiating it the first time if the registry holds its dotted path.
+    Raises KeyError for widgets that aren't registered.
+    """
+    view = _marimo_widgets[widget_name]
+    if callable(view):
+        return view
+    _registry_lock.acquire()
+    try:
+        view = _marimo_widgets[widget_name]
+        if not callable(view):
+            view = smart_import(view)()
+            _marimo_widgets[widget_name] = view
+    finally:
+        _registry_lock.release()
+    return view
+
+
+def load_registry():
+    """
+    Imports and instantiates every registered handler up front and returns
+    the seconds each one took, keyed by widget name. Raises
+    ImproperlyConfigured for entries that can't be loaded, so a bad path
+    fails at startup instead of on a user's request.
+    """
+    timings = {}
+    for widget_name in list(_marimo_widgets):
+        start = time.time()
+        try:
+            load_handler(widget_name)
+        except Exception, e:
+            raise ImproperlyConfigured('marimo widget %r could not be loaded: %s: %s'
+                                       % (widget_name, e.__class__.__name__, e))
+        timings[widget_name] = time.time() - start
+        logger.info('marimo widget %s loaded in %.1fms', widget_name,
+                    timings[widget_name] * 1000)
+    return timings
+
+
+class _WidgetJob(object):
+    """ bookkeeping for a single widget of a bulk request """
+
+    def __init__(self, widget):
+        self.widget = widget
+        self.args = widget.get('args', [])
+        self.kwargs = widget.get('kwargs', {})
+        self.data = {'id': widget['id']}
+        # ids of every widget in the bulk that asked for exactly this
+        self.ids = [widget['id']]
+        self.task = None
+        self.view = None
+        self.cache_key = None
+        # the cache key qualified by the handler's alias and version
+        self.slot = None
+        self.cached = None
+        self.nocache_override = None
+        self.done = False
+        self.timed_out = False
+        # set when nobody waits for the job any more; a worker that hasn't
+        # started it yet skips it
+        self.cancelled = False
+        # 'hit', 'stale' or 'miss' for widgets with a cache key
+        self.cache_status = None
+        # seconds the cacheable part stays fresh, if it came from the cache
+        self.fresh_for = None
+        # seconds spent in each phase, see metrics.widget_timing
+        self.timings = {'cacheable': None, 'uncacheable': None}
+
+    @property
+    def handler(self):
+        """
+        True if the view supports the split cacheable/uncacheable calls: a
+        BaseWidgetHandler that doesn't override __call__ or get_cache, which
+        the split calls would bypass.
+        """
+        if not isinstance(self.view, BaseWidgetHandler):
+            return False
+        for name in ('__call__', 'get_cache'):
+            if name in vars(self.view):
+                return False
+            method = getattr(type(self.view), name)
+            if method.im_func is not getattr(BaseWidgetHandler, name).im_func:
+                return False
+        return True
+
+    def build_cache(self):
+        """ runs the view's cacheable part, timing it """
+        start = time.time()
+        self.cached = self.view.build_cache(*self.args, **self.kwargs)
+        self.timings['cacheable'] = time.time() - start
+        if self.cache_key:
+            self.view.cache_event('regenerate', self.cache_key, self.timings['cacheable'])
+        return self.cached
+
+    def fail(self, e, request):
+        """ hands the current exception to the view's on_error """
+        self.data = self.view.on_error(e, self.data, request, *self.args, **self.kwargs)
+        self.done = True
 
 
 class MarimoRouter(View):
@@ -20,10 +165,32 @@ class MarimoRouter(View):
 
     # TODO store widget registry as class variable so it can be overidden in instances
 
+    # Size of the shared worker pool used to run the widgets of a bulk
+    # request concurrently. 0 runs them one after another on the request
+    # thread.
+    threads = getattr(settings, 'MARIMO_THREADS', 0)
+    # how many widgets may wait for a thread; widgets that find the queue
+    # full are answered with a status of 'timeout'. 0 doesn't limit it.
+    thread_queue = getattr(settings, 'MARIMO_THREAD_QUEUE', 0)
+    # seconds a single widget may run once a worker picks it up
+    widget_timeout = getattr(settings, 'MARIMO_WIDGET_TIMEOUT', None)
+    # seconds the whole bulk request may wait for its widgets
+    bulk_timeout = getattr(settings, 'MARIMO_BULK_TIMEOUT', None)
+    poll_interval = 0.01
+    # threads used to run inlined widgets, and how many may wait for one;
+    # widgets that find the queue full are left to the client
+    inline_threads = getattr(settings, 'MARIMO_INLINE_THREADS', 4)
+    inline_queue = getattr(settings, 'MARIMO_INLINE_QUEUE', 100)
+    # summarize the widgets' timings and cache hits in a Server-Timing header
+    send_server_timing = getattr(settings, 'MARIMO_SERVER_TIMING', False)
+    # how many widget calls the last route() saved by running identical
+    # widgets only once
+    saved_calls = 0
+
     def get(self, request):
         """ for a get request the bulk data is in request.GET """
         try:
-            bulk = json.loads(request.GET['bulk'])
+            bulk = serializers.loads(request.GET['bulk'])
         except KeyError:
             raise Http404()
         else:
@@ -31,9 +198,140 @@ class MarimoRouter(View):
 
     def route(self, request, bulk):
         """ this actually does the routing """
+        start = time.time()
+        jobs, requested = self.prepare(bulk)
+        if self.streaming(request):
+            return self.build_stream_response(request, jobs, start)
+
+        for job in self.execute(request, jobs):
+            pass
+
         response = []
         nocache_override = None
+        for widget_id, job in requested:
+            if job.nocache_override and not job.timed_out:
+                nocache_override = job.nocache_override
+            response.append(self.job_response(job, widget_id))
+
+        known = self.known_templates(request)
+        if known is not None:
+            templates = {}
+            response = [self.reference_template(data, templates, known)
+                        for data in response]
+            response = {'widgets': response, 'templates': templates}
+
+        server_timing = None
+        if self.send_server_timing:
+            server_timing = self.server_timing(jobs)
+        hresp = self.build_response(request, response, nocache_override,
+                                    max_age=self.max_age(jobs), server_timing=server_timing)
+        self.log_slow(request, jobs, start, len(hresp.content))
+        return hresp
+
+    def log_slow(self, request, jobs, start, response_bytes, streamed=False):
+        """
+        Writes a record of the request to the slow request log if it took
+        long enough or is sampled. Never raises.
+        """
+        elapsed = time.time() - start
+        if not slow_log.wants(elapsed):
+            return
+        try:
+            widgets = []
+            for job in jobs:
+                if job.timed_out:
+                    status, size = 'timeout', None
+                else:
+                    status, size = job.data.get('status'), len(serializers.dumps(job.data))
+                widgets.append({
+                    'ids': job.ids,
+                    'widget_name': job.widget['widget_name'],
+                    'args': job.args,
+                    'kwargs': slow_log.redact(job.kwargs),
+                    'status': status,
+                    'cache': job.cache_status,
+                    'timings': job.timings,
+                    'bytes': size,
+                })
+            bulk = request.GET.get('bulk')
+            slow_log.write({
+                'time': start,
+                'elapsed': elapsed,
+                'path': request.path,
+                'streamed': streamed,
+                'request_bytes': isinstance(bulk, basestring) and len(bulk) or None,
+                'response_bytes': response_bytes,
+                'saved_calls': self.saved_calls,
+                'widgets': widgets,
+            })
+        except Exception:
+            logger.exception('could not write the marimo slow request log')
+
+
+    def known_templates(self, request):
+        """
+        If the client asked for templates by reference (template_refs=1),
+        returns the set of template hashes it says it already has in
+        known_templates. Otherwise returns None.
+
+        Such clients get ``{"widgets": [...], "templates": {hash: template}}``
+        where each widget has a template_hash instead of a template, and
+        every template they don't already have is sent once.
+        """
+        if request.REQUEST.get('template_refs') != '1':
+            return None
+        known = request.REQUEST.get('known_templates') or ''
+        return set(thash for thash in known.split(',') if thash)
+
+    def reference_template(self, data, templates, known):
+        """
+        Returns a copy of data that refers to its template by hash, adding
+        the template to templates unless the client knows it already.
+        """
+        template = data.get('template')
+        if not isinstance(template, basestring):
+            return data
+        data = dict(data)
+        del data['template']
+        thash = data['template_hash'] = template_hash(template)
+        if thash not in known:
+            templates[thash] = template
+        return data
+
+    def max_age(self, jobs):
+        """
+        How long the client may reuse the bulk response: the shortest time
+        any of its widgets' cache entries stays fresh. None if any widget
+        isn't cached, failed or timed out, or if an entry's age is unknown.
+        """
+        ages = []
+        for job in jobs:
+            if job.timed_out or job.data.get('status') != 'succeeded':
+                return None
+            if not (job.handler and job.cache_key):
+                return None
+            if job.cache_status in ('hit', 'stale'):
+                age = job.fresh_for
+            else:
+                # regenerated for this request
+                age = job.view.fresh_for()
+            if age is None:
+                return None
+            ages.append(age)
+        if ages:
+            return int(min(ages))
+
+    def prepare(self, bulk):
+        """
+        Cleans the bulk data and looks up a handler for every distinct widget.
+
+        Returns the list of jobs to run and a list of (widget id, job) pairs
+        in bulk order; identical widget specs share a job.
+        """
         # TODO sanitize bulk
+        jobs = []
+        requested = []
+        by_spec = {}
         for widget in bulk:
             # Clean kwargs; these are passed to python functions and can open
             # us up to basic string injection attacks. any sensitive args
@@ -46,46 +344,635 @@ class MarimoRouter(View):
                     clean_widget_kwargs[str(key)] = widget['kwargs'][key]
             widget['kwargs'] = clean_widget_kwargs
 
-            # Try to get a callable from the dict... if it's not imported deal with it
-            data = { 'id': widget['id'], }
+            spec = self.spec_key(widget)
+            if spec in by_spec:
+                by_spec[spec].ids.append(widget['id'])
+                requested.append((widget['id'], by_spec[spec]))
+                continue
+
+            job = _WidgetJob(widget)
             try:
-                # TODO widget_name -> widget_handler; also fall back to widget_id and widget_prototype in searching for handler.
-                view = _marimo_widgets[widget['widget_name']]
+                job.view = self.get_view(widget['widget_name'])
             except KeyError:
-                data['status'] = 'WidgetNotFound'
+                job.data['status'] = 'WidgetNotFound'
+                job.done = True
+            jobs.append(job)
+            by_spec[spec] = job
+            requested.append((widget['id'], job))
+
+        self.saved_calls = len(requested) - len(jobs)
+        if self.saved_calls:
+            logger.debug('marimo bulk request: %d widgets, %d duplicate calls saved',
+                         len(requested), self.saved_calls)
+        return jobs, requested
+
+    def get_view(self, widget_name):
+        """ returns the handler registered for widget_name or raises KeyError """
+        # TODO widget_name -> widget_handler; also fall back to widget_id and widget_prototype in searching for handler.
+        return load_handler(widget_name)
+
+    def prefetch(self, request, widgets, budget, selected_only=False, skip_nocache=False):
+        """
+        Runs widgets for a page that is still being generated, so their
+        responses can be embedded in the page itself.
+
+        Returns a ({widget id: response data}, nocache override) tuple for
+        the widgets that succeeded within budget seconds. With
+        selected_only, only widgets whose handler sets ``inline`` are run.
+        With skip_nocache, widgets that return a ``__nocache_override`` are
+        left out, for pages whose headers have already been sent.
+        Widgets run on a pool of their own, so pages can't hold up bulk
+        requests, and are given up on once the budget is spent.
+        """
+        start = time.time()
+        bulk = []
+        for widget in widgets:
+            if selected_only:
+                try:
+                    view = self.get_view(widget['widget_name'])
+                except KeyError:
+                    continue
+                if not getattr(view, 'inline', False):
+                    continue
+            # prepare() cleans kwargs in place; the page still needs them
+            widget = dict(widget)
+            widget['kwargs'] = dict(widget.get('kwargs', {}))
+            bulk.append(widget)
+
+        results = {}
+        nocache_override = None
+        if not bulk:
+            return results, nocache_override
+        jobs, requested = self.prepare(bulk)
+        # always on workers, so a slow widget can't hold up the page
+        pool = get_pool('inline', self.inline_threads, self.inline_queue)
+        remaining = max(0, budget - (time.time() - start))
+        finished = self.execute(request, jobs, batch_writes=False,
+                                bulk_timeout=remaining or 0.001, pool=pool)
+        try:
+            for job in finished:
+                if time.time() - start > budget:
+                    # anything finishing now is too late for the page
+                    break
+                if skip_nocache and job.nocache_override:
+                    continue
+                if not job.timed_out and job.data.get('status') == 'succeeded':
+                    for widget_id in job.ids:
+                        results[widget_id] = self.job_response(job, widget_id)
+                    nocache_override = job.nocache_override or nocache_override
+        finally:
+            # cancels the widgets that haven't started yet
+            finished.close()
+        return results, nocache_override
+
+    def execute(self, request, jobs, batch_writes=True, bulk_timeout=None, pool=None):
+        """
+        Runs the jobs, yielding each one as soon as it is finished (or has
+        timed out).
+
+        With MARIMO_THREADS or a pool the jobs run on worker threads and
+        nothing is waited for past bulk_timeout (MARIMO_BULK_TIMEOUT by
+        default) seconds.
+
+        Cache reads are always batched. With batch_writes, regenerated cache
+        entries are written with one ``set_many`` as well, which means no job
+        finishes before every miss has been regenerated; streaming responses
+        turn it off so fast widgets aren't held up by slow cacheable() calls.
+        """
+        if pool is None and self.threads:
+            pool = get_pool('router', self.threads, self.thread_queue)
+        regenerate = batch_writes and pool is None
+        self.fetch_cached(request, jobs, regenerate=regenerate)
+        for job in jobs:
+            if job.done:
+                self.record(job)
+                yield job
+        if pool is not None:
+            if bulk_timeout is None:
+                bulk_timeout = self.bulk_timeout
+            threaded = self.run_threaded(request, jobs, pool, bulk_timeout)
+            try:
+                for job in threaded:
+                    self.record(job)
+                    yield job
+            finally:
+                threaded.close()
+        else:
+            for job in jobs:
+                if not job.done:
+                    self.run_job(request, job)
+                    self.record(job)
+                    yield job
+
+    def record(self, job):
+        """ reports a finished job's timings to the metrics hook """
+        if job.view is None:
+            return
+        timings = dict(job.timings)
+        if job.timed_out:
+            # the worker may still be writing these
+            timings['uncacheable'] = None
+        phases = [t for t in (timings['cacheable'], timings['uncacheable']) if t is not None]
+        timings['total'] = phases and sum(phases) or None
+        job.timings = timings
+        metrics.widget_timing(job.widget['widget_name'], job.widget['id'],
+                              job.cache_status, timings)
+
+    def server_timing(self, jobs):
+        """
+        A Server-Timing header value summing up jobs: the time spent in the
+        cacheable and uncacheable phases, cache hits and misses, and the
+        slowest widget.
+        """
+        cacheable = uncacheable = 0.0
+        statuses = {}
+        slowest = None
+        for job in jobs:
+            if job.view is None:
+                continue
+            cacheable += job.timings.get('cacheable') or 0
+            uncacheable += job.timings.get('uncacheable') or 0
+            if job.cache_status:
+                statuses[job.cache_status] = statuses.get(job.cache_status, 0) + 1
+            total = job.timings.get('total')
+            if total is not None and (slowest is None or total > slowest.timings['total']):
+                slowest = job
+        entries = [
+            'marimo-cacheable;dur=%.1f' % (cacheable * 1000),
+            'marimo-uncacheable;dur=%.1f' % (uncacheable * 1000),
+        ]
+        if statuses:
+            entries.append('marimo-cache;desc="%s"' % ' '.join(
+                '%s=%d' % item for item in sorted(statuses.items())))
+        if slowest is not None:
+            entry = 'marimo-slowest;dur=%.1f' % (slowest.timings['total'] * 1000)
+            # the id comes from the client; only keep what can't break the header
+            widget_id = NON_TOKEN.sub('', smart_str(slowest.widget['id']))
+            if widget_id:
+                entry += ';desc=%s' % widget_id
+            entries.append(entry)
+        return ', '.join(entries)
+
+    def job_response(self, job, widget_id):
+        """ the response data of a finished job for one of its widget ids """
+        if job.timed_out:
+            return {'id': widget_id, 'status': 'timeout'}
+        if widget_id == job.widget['id']:
+            return job.data
+        data = dict(job.data)
+        data['id'] = widget_id
+        return data
+
+    def spec_key(self, widget):
+        """
+        A canonical key for what a widget asks for. Widgets with the same
+        name, args and kwargs get the same response, so only one of them is
+        run.
+        """
+        return json.dumps([widget['widget_name'], widget.get('args', []),
+                           widget.get('kwargs', {})], sort_keys=True)
+
+    def run_job(self, request, job):
+        """
+        Does whatever work is left for a single widget and fills in job.data.
+
+        A handler whose cacheable part wasn't filled in by fetch_cached() is
+        regenerated here and written back to the cache on its own.
+        """
+        data = job.data
+        view = job.view
+        try:
+            if job.handler:
+                if job.cached is None and job.cache_key:
+                    start = time.time()
+                    job.cached = view.regenerate_cache(job.cache_key, *job.args, **job.kwargs)
+                    job.timings['cacheable'] = time.time() - start
+                    job.cache_status = job.cache_status or 'miss'
+                elif job.cached is None:
+                    job.build_cache()
+                start = time.time()
+                view_data = view.finalize(request, job.cached, *job.args, **job.kwargs)
             else:
-                if not callable(view):
-                    view = smart_import(view)()
-                    _marimo_widgets[widget['widget_name']] = view
+                start = time.time()
+                # req, args, kwargs -> dict
+                view_data = view(request, *job.args, **job.kwargs)
+            job.timings['uncacheable'] = time.time() - start
+            if '__nocache_override' in view_data:
+                job.nocache_override = view_data['__nocache_override']
+                del view_data['__nocache_override']
+            data.update(view_data)
+        except Exception, e:
+            job.fail(e, request)
+        else:
+            data['status'] = 'succeeded'
+            job.done = True
 
+    def run_threaded(self, request, jobs, pool, bulk_timeout=None):
+        """
+        Runs the remaining jobs on the worker pool and yields them in the
+        order they finish.
+
+        A widget gets at most ``widget_timeout`` seconds once a worker picks
+        it up, and nothing is waited for past ``bulk_timeout`` seconds after
+        this call. Widgets that miss their deadline are yielded with
+        ``timed_out`` set and are answered with a status of 'timeout'; those
+        a worker already started finish in the background and still write
+        any regenerated cache entry, the others are never run. Widgets that
+        find the pool's queue full are answered the same way.
+
+        Jobs still outstanding when the caller stops iterating are
+        cancelled: workers that haven't picked them up yet skip them.
+        """
+        start = time.time()
+        finished = Queue.Queue()
+
+        def run(job):
+            try:
+                if not job.cancelled:
+                    self.run_job(request, job)
+            finally:
+                finished.put(job)
+
+        outstanding = set()
+        full = []
+        for job in jobs:
+            if not job.done:
+                job.task = pool.try_submit(run, job)
+                if job.task is None:
+                    job.timed_out = True
+                    full.append(job)
+                else:
+                    outstanding.add(job)
+        bulk_deadline = None
+        if bulk_timeout:
+            bulk_deadline = start + bulk_timeout
+        try:
+            for job in full:
+                yield job
+            while outstanding:
+                now = time.time()
+                wait = None
+                for job in list(outstanding):
+                    deadline = self.job_deadline(job, bulk_deadline)
+                    if deadline is not None and deadline <= now:
+                        # the worker keeps going in the background and may
+                        # still touch job.data, so the response must not use
+                        # it; if no worker has started it, none will
+                        job.timed_out = True
+                        job.cancelled = True
+                        outstanding.remove(job)
+                        yield job
+                        continue
+                    if deadline is not None:
+                        wait = deadline - now if wait is None else min(wait, deadline - now)
+                    if job.task.started is None and self.job_timeout(job):
+                        # not picked up yet; check back once it gets a deadline
+                        wait = self.poll_interval if wait is None else min(wait, self.poll_interval)
+                if not outstanding:
+                    break
                 try:
-                    data.update(view(request, *widget.get('args', []), **widget.get('kwargs', {})))
-                    # req, args, kwargs -> dict
-                    view_data = view(request, *widget.get('args', []), **widget.get('kwargs', {}))
-                    if '__nocache_override' in view_data:
-                        nocache_override = view_data['__nocache_override']
-                        del view_data['__nocache_override']
-                    data.update(view_data)
-                except Exception, e:
-                    data = view.on_error(e, data, request, *widget['args'], **widget['kwargs'])
+                    job = finished.get(True, wait)
+                except Queue.Empty:
+                    continue
+                if job in outstanding:
+                    outstanding.remove(job)
+                    yield job
+        finally:
+            for job in outstanding:
+                job.cancelled = True
+
+    def job_timeout(self, job):
+        """ seconds the job may run on a worker, or None """
+        return getattr(job.view, 'widget_timeout', None) or self.widget_timeout
+
+    def job_deadline(self, job, bulk_deadline):
+        """ the time after which the router stops waiting for a threaded job """
+        deadline = bulk_deadline
+        timeout = self.job_timeout(job)
+        if timeout and job.task.started is not None:
+            widget_deadline = job.task.started + timeout
+            if deadline is None or widget_deadline < deadline:
+                deadline = widget_deadline
+        return deadline
+
+    def warm(self, request, widgets):
+        """
+        Fills the cache for the cacheable half of widgets without running
+        uncacheable(), so a bulk request that follows finds them cached.
+        Keys that are already cached are only read, and keys someone else
+        holds the regeneration lease for are left to them.
+        """
+        bulk = []
+        for widget in widgets:
+            widget = dict(widget)
+            widget['kwargs'] = dict(widget.get('kwargs', {}))
+            bulk.append(widget)
+        jobs, requested = self.prepare(bulk)
+        # what can't be cached would only be computed and thrown away
+        self.fetch_cached(request, jobs, wait=False, keyless=False)
+
+    def fetch_cached(self, request, jobs, regenerate=True, wait=True, keyless=True):
+        """
+        Fills in the cacheable part of every BaseWidgetHandler job.
+
+        All cache keys in the bulk are read with a single ``get_many``,
+        cacheable() only runs for the misses, and the regenerated entries are
+        written back with a single ``set_many``. Widgets whose cache_key() is
+        None are regenerated and not cached, just like
+        :meth:`BaseWidgetHandler.get_cache`.
+
+        With regenerate=False misses are left for run_job() to fill in. With
+        wait=False keys that another caller is regenerating are skipped
+        instead of waited for. With keyless=False widgets without a cache key
+        are skipped as well.
+        """
+        pending = []
+        for job in jobs:
+            if job.done or not job.handler:
+                continue
+            try:
+                job.cache_key = job.view.cache_key(*job.args, **job.kwargs)
+            except Exception, e:
+                job.fail(e, request)
+            else:
+                if job.cache_key or keyless:
+                    pending.append(job)
+
+        # Handlers can use their own cache alias and key version, so keys
+        # are tracked by slot (alias, version and key in one string) and the
+        # round trips are grouped per alias and version.
+        hits = {}
+        remote = {}
+        for job in pending:
+            if not job.cache_key:
+                continue
+            view = job.view
+            job.slot = view.local_key(job.cache_key)
+            if job.slot in hits:
+                continue
+            if view.local_cache_timeout:
+                value = local_cache.get(job.slot)
+                if value is not None:
+                    hits[job.slot] = value
+                    continue
+            group = remote.setdefault((view.cache_alias, view.cache_version), {})
+            group[job.cache_key] = job
+        for (alias, version), group in remote.items():
+            fetched = cache_for_alias(alias).get_many(group.keys(), version=version)
+            for key, value in fetched.items():
+                job = group[key]
+                if job.view.local_cache_timeout:
+                    local_cache.set(job.slot, value, job.view.local_cache_timeout)
+                hits[job.slot] = value
+
+        misses = {}
+        # writes are grouped by alias, version and timeout
+        writes = {}
+        # jobs holding a regeneration lease, and jobs whose key someone else
+        # is regenerating
+        locked = []
+        contended = []
+        contended_slots = set()
+        unpacked = set()
+        for job in pending:
+            if job.slot in hits:
+                value = hits[job.slot]
+                if job.slot in unpacked:
+                    # widgets with different specs can share a key; each
+                    # needs its own copy so uncacheable() can't leak
+                    # between them.
+                    value = copy.deepcopy(value)
+                unpacked.add(job.slot)
+                job.cached, stale = job.view.unpack_cache(value)
+                job.fresh_for = job.view.fresh_for(value)
+                if job.cached is None:
+                    # its template is gone; run_job() regenerates it
+                    job.cache_status = 'miss'
+                elif stale:
+                    job.cache_status = 'stale'
+                    job.view.schedule_refresh(job.cache_key, *job.args, **job.kwargs)
                 else:
-                    data['status'] = 'succeeded'
-            finally:
-                response.append(data)
+                    job.cache_status = 'hit'
+                job.view.cache_event(job.cache_status, job.cache_key)
+                continue
+            if job.cache_key:
+                job.cache_status = 'miss'
+                job.view.cache_event('miss', job.cache_key)
+            if not regenerate:
+                continue
+            if job.slot in misses:
+                # another widget in this bulk already regenerated this key;
+                # copy it so uncacheable() can't leak between widgets.
+                job.cached = copy.deepcopy(misses[job.slot])
+            elif job.cache_key and (job.slot in contended_slots
+                                    or not job.view.acquire_cache_lock(job.cache_key)):
+                contended.append(job)
+                contended_slots.add(job.slot)
+            else:
+                if job.cache_key:
+                    locked.append(job)
+                try:
+                    job.build_cache()
+                except Exception, e:
+                    job.fail(e, request)
+                    continue
+                if job.cache_key:
+                    view = job.view
+                    misses[job.slot] = job.cached
+                    group = (view.cache_alias, view.cache_version, view.cache_timeout)
+                    writes.setdefault(group, []).append(job)
+
+        for (alias, version, timeout), group in writes.items():
+            values = {}
+            for job in group:
+                values.update(job.view.cache_values(job.cache_key, job.cached))
+                if job.view.local_cache_timeout:
+                    local_cache.set(job.slot, values[job.cache_key],
+                                    job.view.local_cache_timeout)
+            set_many(cache_for_alias(alias), values, timeout, version=version)
+
+        lock_keys = {}
+        for job in locked:
+            if job.view.cache_lock_timeout:
+                group = lock_keys.setdefault((job.view.cache_alias, job.view.cache_version), [])
+                group.append(LOCK_PREFIX + job.cache_key)
+        for (alias, version), keys in lock_keys.items():
+            cache_for_alias(alias).delete_many(keys, version=version)
+
+        if contended and wait:
+            self.wait_for_contended(request, contended)
 
-        return self.build_response(request, response, nocache_override)
+    def wait_for_contended(self, request, jobs):
+        """
+        Waits for cache entries that other callers hold the regeneration
+        lease for, regenerating the ones that don't show up in time.
 
-    def build_response(self, request, data, nocache_override=None):
-        as_json = json.dumps(data)
+        All keys share one wait: every poll reads the keys still missing with
+        a single ``get_many`` per alias and version, and each key is given up
+        on cache_lock_wait seconds (of its handler) after the wait started.
+        """
+        start = time.time()
+        poll = min(job.view.cache_lock_poll for job in jobs)
+        # (alias, version) -> {cache key: slot}, and slot -> deadline
+        groups = {}
+        deadlines = {}
+        for job in jobs:
+            view = job.view
+            groups.setdefault((view.cache_alias, view.cache_version), {})[job.cache_key] = job.slot
+            deadlines[job.slot] = max(deadlines.get(job.slot, 0), start + view.cache_lock_wait)
+        found = {}
+        while True:
+            now = time.time()
+            polls = []
+            for (alias, version), keys in groups.items():
+                remaining = [key for key, slot in keys.items()
+                             if slot not in found and deadlines[slot] > now]
+                if remaining:
+                    polls.append((alias, version, remaining))
+            if not polls:
+                break
+            time.sleep(poll)
+            for alias, version, remaining in polls:
+                values = cache_for_alias(alias).get_many(remaining, version=version)
+                for key, value in values.items():
+                    found[groups[(alias, version)][key]] = value
+        for slot in deadlines:
+            count_lock('waited' if slot in found else 'wait_timeout')
+
+        regenerated = {}
+        for job in jobs:
+            if job.slot in found:
+                job.cached = copy.deepcopy(job.view.unpack_cache(found[job.slot])[0])
+                if job.cached is not None:
+                    continue
+            if job.slot in regenerated:
+                job.cached = copy.deepcopy(regenerated[job.slot])
+                continue
+            try:
+                job.build_cache()
+            except Exception, e:
+                job.fail(e, request)
+            else:
+                job.view.set_cache(job.cache_key, job.cached)
+                regenerated[job.slot] = job.cached
+
+    def etag_matches(self, request, etag):
+        """ True if the request's If-None-Match header covers etag """
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+
+    def streaming(self, request):
+        """ True if the client asked for one JSON record per line as widgets finish """
+        return request.REQUEST.get('format') == 'ndjson'
+
+    def stream(self, request, jobs, start=None):
+        """
+        Yields one newline terminated JSON record per requested widget id as
+        soon as its job finishes, followed by a trailer record carrying data
+        about the whole bulk request, such as the Cache-Control override that
+        could no longer be sent as a header.
+        """
+        nocache_override = None
+        count = 0
+        sent = 0
+        known = self.known_templates(request)
+        for job in self.execute(request, jobs, batch_writes=False):
+            if job.nocache_override and not job.timed_out:
+                nocache_override = job.nocache_override
+            for widget_id in job.ids:
+                count += 1
+                data = self.job_response(job, widget_id)
+                if known is not None:
+                    # templates go out in their own record the first time
+                    # they are needed
+                    templates = {}
+                    data = self.reference_template(data, templates, known)
+                    for thash, template in templates.items():
+                        known.add(thash)
+                        record = serializers.dumps({'__template': thash, 'template': template}) + '\n'
+                        sent += len(record)
+                        yield record
+                record = serializers.dumps(data) + '\n'
+                sent += len(record)
+                yield record
+        trailer = {
+            'widgets': count,
+            'saved_calls': self.saved_calls,
+            'cache_control': nocache_override,
+        }
+        record = serializers.dumps({'__trailer': trailer}) + '\n'
+        yield record
+        if start is not None:
+            self.log_slow(request, jobs, start, sent + len(record), streamed=True)
+
+    def build_stream_response(self, request, jobs, start=None):
+        """
+        Returns a response that runs the widgets while it is being sent. The
+        body is newline delimited JSON, see :meth:`stream`.
+        """
+        return StreamingHttpResponse(self.stream(request, jobs, start),
+                                     content_type='application/x-ndjson')
+
+    def accepts(self, request, content_types):
+        """ True if the Accept header lists one of content_types """
+        for media_range in request.META.get('HTTP_ACCEPT', '').split(','):
+            params = media_range.split(';')
+            if params[0].strip().lower() not in content_types:
+                continue
+            for param in params[1:]:
+                name, _, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+        return False
+
+    def build_response(self, request, data, nocache_override=None, max_age=None,
+                       server_timing=None):
+        """
+        Serializes the widget data: JSON by default, JSONP for format=jsonp
+        and, if msgpack is installed, MessagePack for clients whose Accept
+        header asks for it. The response carries an ETag of its content and
+        is answered with a 304 if the client already has it.
+
+        Unless a widget asked for nocache_override, a private Cache-Control
+        max-age of max_age seconds is sent. server_timing, if given, is sent as the
+        Server-Timing header.
+        """
+        binary = serializers.msgpack_serializer
         if request.REQUEST.get('format') == 'jsonp' and request.REQUEST.get('callback'):
             content_type = 'text/javascript'
             callback = request.REQUEST.get('callback')
-            as_json = "{0}({1});".format(callback, as_json)
+            as_json = "{0}({1});".format(callback, serializers.dumps(data))
+        elif binary and self.accepts(request, MSGPACK_TYPES):
+            content_type = binary.content_type
+            as_json = binary.dumps(data)
         else:
             content_type = 'application/json'
+            as_json = serializers.dumps(data)
 
-        hresp = HttpResponse(as_json, content_type=content_type)
+        etag = '"%s"' % hashlib.md5(smart_str(as_json)).hexdigest()
+        if self.etag_matches(request, etag):
+            hresp = HttpResponseNotModified()
+        else:
+            hresp = HttpResponse(as_json, content_type=content_type)
+        hresp['ETag'] = etag
+        if binary:
+            # the body depends on Accept once there is a choice of formats
+            hresp['Vary'] = 'Accept'
         if nocache_override:
             hresp['Cache-Control'] = nocache_override
+        elif max_age is not None:
+            # every widget's uncacheable() part may be per user
+            hresp['Cache-Control'] = 'private, max-age=%d' % max_age
+        if self.saved_calls:
+            hresp['X-Marimo-Saved-Calls'] = str(self.saved_calls)
+        if server_timing:
+            hresp['Server-Timing'] = server_timing
 
         return hresp